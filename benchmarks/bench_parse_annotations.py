@@ -0,0 +1,90 @@
+"""Benchmark parsing of the HCP annotation files
+
+Writes synthetic bad channel, bad segment and ICA annotation files for
+many subjects and runs to a temporary directory, then times reading and
+parsing all of them, e.g.::
+
+    $ python benchmarks/bench_parse_annotations.py --n-subjects 1000
+"""
+
+import argparse
+import os.path as op
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from hcp.io.read import (_parse_annotations_bad_channels,
+                         _parse_annotations_segments,
+                         _parse_annotations_ica)
+
+rng = np.random.RandomState(42)
+
+
+def _make_channels():
+    lines = list()
+    for key in ('all', 'ica', 'manual', 'neigh_corr', 'neigh_stdratio'):
+        chans = ['A%d' % c for c in rng.randint(1, 249, rng.randint(0, 8))]
+        lines.append("badchannel.%s = {%s};" % (
+            key, ' '.join("'%s'" % c for c in chans)))
+    return '\n'.join(lines) + '\n'
+
+
+def _make_segments():
+    lines = list()
+    for key in ('all', 'ica', 'manual'):
+        segments = np.sort(rng.randint(1, 600000, (rng.randint(0, 40), 2)))
+        lines.append('badsegment.%s = [\n%s\n];' % (
+            key, '\n'.join('    %d %d' % tuple(s) for s in segments)))
+    return '\n'.join(lines) + '\n'
+
+
+def _make_ica():
+    lines = list()
+    for key in ('bad', 'brain_ic', 'brain_ic_vs', 'ecg_eog_ic', 'good',
+                'physio'):
+        comps = np.sort(rng.choice(np.arange(1, 139), rng.randint(0, 40),
+                                   replace=False))
+        lines.append('IC.%s = [%s];' % (key, ' '.join(map(str, comps))))
+    for key in ('brain_ic_number', 'brain_ic_vs_number', 'total_ic_number',
+                'flag'):
+        lines.append('IC.%s = %d;' % (key, rng.randint(1, 139)))
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n-subjects', type=int, default=1000)
+    parser.add_argument('--n-runs', type=int, default=10)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        makers = [(_make_channels, _parse_annotations_bad_channels),
+                  (_make_segments, _parse_annotations_segments),
+                  (_make_ica, _parse_annotations_ica)]
+        # a few distinct contents are enough, parsing time does not depend
+        # on which subject a file belongs to
+        contents = [[make() for _ in range(20)] for make, _ in makers]
+        files = list()
+        for ii in range(args.n_subjects * args.n_runs):
+            for jj, (_, parse) in enumerate(makers):
+                fname = op.join(tmp, '%d-%d.txt' % (ii, jj))
+                with open(fname, 'w') as fid:
+                    fid.write(contents[jj][ii % 20])
+                files.append((fname, parse))
+
+        t0 = time.time()
+        for fname, parse in files:
+            with open(fname) as fid:
+                parse(fid.read())
+        duration = time.time() - t0
+    finally:
+        shutil.rmtree(tmp)
+    print('parsed %d files (%d subjects x %d runs x 3) in %0.2f s' % (
+          len(files), args.n_subjects, args.n_runs, duration))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+# Author: Denis A. Engemann <denis.engemann@gmail.com>
+# License: BSD (3-clause)
+"""
+Command line interface, run ``hcp --help`` for the available commands.
+"""
+
+import argparse
+
+from . import hcp_cache
+
+_commands = [hcp_cache]
+
+
+def main(argv=None):
+    """Run the ``hcp`` command line tool"""
+    parser = argparse.ArgumentParser(prog='hcp', description=__doc__)
+    subparsers = parser.add_subparsers(dest='command')
+    for command in _commands:
+        command.add_parser(subparsers)
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 1
+    return args.func(args)
@@ -0,0 +1,55 @@
+# Author: Denis A. Engemann <denis.engemann@gmail.com>
+# License: BSD (3-clause)
+"""Manage the binary cache of preprocessed HCP data
+
+Example usage::
+
+    $ hcp cache build --subject 100307 --hcp-path /media/crazy_disk/HCP \
+        --cache-dir /ssd/hcp-cache
+"""
+
+import os.path as op
+
+
+def add_parser(subparsers):
+    """Add the ``cache`` command"""
+    parser = subparsers.add_parser(
+        'cache', help='manage the binary cache of preprocessed data')
+    actions = parser.add_subparsers(dest='action')
+    build = actions.add_parser(
+        'build', help='convert preprocessed data of subjects to the cache')
+    build.add_argument('--subject', dest='subjects', action='append',
+                       required=True,
+                       help='the subject, can be given several times')
+    build.add_argument('--data-type', dest='data_types', action='append',
+                       help='the data type, can be given several times. '
+                            'Defaults to all types with preprocessed data.')
+    build.add_argument('--output', dest='outputs', action='append',
+                       choices=('epochs', 'trial_info', 'ica', 'annot'),
+                       help='the output, can be given several times. '
+                            'Defaults to all outputs.')
+    build.add_argument('--hcp-path', dest='hcp_path', default=op.curdir,
+                       help='the HCP directory')
+    build.add_argument('--cache-dir', dest='cache_dir', default=None,
+                       help='the cache directory, defaults to the MNE '
+                            'config variable MNE_HCP_CACHE_DIR')
+    build.set_defaults(func=run_build)
+    parser.set_defaults(func=lambda args: parser.print_help() or 1)
+
+
+def run_build(args):
+    """Run ``hcp cache build``"""
+    from ..io import build_cache_hcp
+    kwargs = dict(hcp_path=args.hcp_path, cache_dir=args.cache_dir)
+    if args.data_types:
+        kwargs['data_types'] = args.data_types
+    if args.outputs:
+        kwargs['outputs'] = args.outputs
+    n_failed = 0
+    for subject in args.subjects:
+        failed = build_cache_hcp(subject=subject, **kwargs)
+        for data_type, run_index, output in failed:
+            print('%s: could not cache %s of %s run %d' % (
+                  subject, output, data_type, run_index))
+        n_failed += len(failed)
+    return 1 if n_failed else 0
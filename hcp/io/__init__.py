@@ -1,5 +1,10 @@
 from .read import (
     read_ica_hcp, read_raw_hcp, read_info_hcp, read_annot_hcp, read_epochs_hcp,
-    read_trial_info_hcp)
+    read_trial_info_hcp, iter_raw_hcp)
+from .cache import build_cache_hcp
+from .batch import iter_hcp_batch, read_epochs_hcp_batch
+from .download import download_hcp_files, get_backend
+from .store import FileStore, get_store
+from .prefetch import prefetch_hcp_subjects
 
 from . import file_mapping
\ No newline at end of file
@@ -0,0 +1,159 @@
+# Author: Denis A. Engemann <denis.engemann@gmail.com>
+# License: BSD (3-clause)
+
+import itertools as itt
+import multiprocessing
+from collections import deque
+from concurrent.futures import (ProcessPoolExecutor, wait,
+                                FIRST_COMPLETED)
+
+from mne.utils import logger
+
+from .read import read_epochs_hcp
+
+
+def _get_n_jobs(n_jobs):
+    """helper to handle negative n_jobs like MNE does"""
+    if n_jobs == 0:
+        raise ValueError('`n_jobs` must not be 0, use 1 to work in this '
+                         'process or -1 to use all CPUs.')
+    if n_jobs < 0:
+        n_jobs = max(multiprocessing.cpu_count() + 1 + n_jobs, 1)
+    return n_jobs
+
+
+def _result(item, future):
+    """helper to unpack a future without raising"""
+    subject, run_index = item
+    try:
+        return subject, run_index, future.result(), None
+    except Exception as err:
+        logger.warning('reading %s run %d failed: %s' % (
+                       subject, run_index, err))
+        return subject, run_index, None, err
+
+
+def iter_hcp_batch(reader, subjects, data_type, run_indices=(0,), n_jobs=1,
+                   ordered=True, max_in_flight=None, **kwargs):
+    """Apply a reader to many subjects and runs in parallel
+
+    Parameters
+    ----------
+    reader : callable
+        The reader, e.g., `hcp.io.read_epochs_hcp`. It is called as
+        ``reader(subject=subject, data_type=data_type,
+        run_index=run_index, **kwargs)`` and must be importable from a
+        module, such that worker processes can use it.
+    subjects : list of str
+        The subjects.
+    data_type : str
+        The kind of data to read, see the reader.
+    run_indices : list of int
+        The runs to read for each subject. Defaults to (0,).
+    n_jobs : int
+        The number of worker processes. If 1, the items are read one
+        after another in this process. Negative values count from the
+        number of CPUs, e.g., -1 uses all CPUs.
+    ordered : bool
+        If True (default), results are yielded in the order of `subjects`
+        and `run_indices`. If False, results are yielded as soon as they
+        are done.
+    max_in_flight : int | None
+        The maximum number of items read or waiting to be consumed at any
+        time, this bounds the memory used by results. Defaults to twice
+        the number of workers.
+    **kwargs : dict
+        Further arguments passed to the reader, e.g., `hcp_path`.
+
+    Returns
+    -------
+    results : generator
+        Yields tuples of (subject, run_index, out, error). If reading
+        failed, out is None and error is the exception, the remaining
+        items are still read.
+    """
+    items = list(itt.product(subjects, run_indices))
+    n_jobs = _get_n_jobs(n_jobs)
+    if n_jobs == 1:
+        for subject, run_index in items:
+            try:
+                out = reader(subject=subject, data_type=data_type,
+                             run_index=run_index, **kwargs)
+            except Exception as err:
+                logger.warning('reading %s run %d failed: %s' % (
+                               subject, run_index, err))
+                yield subject, run_index, None, err
+            else:
+                yield subject, run_index, out, None
+        return
+
+    if max_in_flight is None:
+        max_in_flight = 2 * n_jobs
+    if max_in_flight < 1:
+        raise ValueError('`max_in_flight` must be at least 1, got %s.' %
+                         max_in_flight)
+    items = iter(items)
+    pending = deque()  # (item, future) in submission order
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        def submit():
+            for subject, run_index in items:
+                future = executor.submit(
+                    reader, subject=subject, data_type=data_type,
+                    run_index=run_index, **kwargs)
+                pending.append(((subject, run_index), future))
+                return True
+            return False
+
+        while len(pending) < max_in_flight and submit():
+            pass
+        while pending:
+            if ordered:
+                item, future = pending.popleft()
+            else:
+                done, _ = wait([f for _, f in pending],
+                               return_when=FIRST_COMPLETED)
+                item, future = [p for p in pending if p[1] in done][0]
+                pending.remove((item, future))
+            result = _result(item, future)
+            submit()
+            yield result
+
+
+def read_epochs_hcp_batch(subjects, data_type, run_indices=(0,), n_jobs=1,
+                          ordered=True, max_in_flight=None, **kwargs):
+    """Read HCP processed data of many subjects and runs in parallel
+
+    Parameters
+    ----------
+    subjects : list of str
+        The subjects.
+    data_type : str
+        The kind of data to read. The following options are supported:
+        'rest'
+        'task_motor'
+        'task_story_math'
+        'task_working_memory'
+    run_indices : list of int
+        The runs to read for each subject. Defaults to (0,).
+    n_jobs : int
+        The number of worker processes. Defaults to 1.
+    ordered : bool
+        If True (default), results are yielded in the order of `subjects`
+        and `run_indices`, else as soon as they are done.
+    max_in_flight : int | None
+        The maximum number of epochs read or waiting to be consumed at any
+        time. Defaults to twice the number of workers.
+    **kwargs : dict
+        Further arguments passed to `hcp.io.read_epochs_hcp`, e.g.,
+        `hcp_path`.
+
+    Returns
+    -------
+    results : generator
+        Yields tuples of (subject, run_index, epochs, error), see
+        `hcp.io.iter_hcp_batch`.
+    """
+    return iter_hcp_batch(
+        read_epochs_hcp, subjects=subjects, data_type=data_type,
+        run_indices=run_indices, n_jobs=n_jobs, ordered=ordered,
+        max_in_flight=max_in_flight, **kwargs)
@@ -0,0 +1,334 @@
+# Author: Denis A. Engemann <denis.engemann@gmail.com>
+# License: BSD (3-clause)
+
+import os
+import os.path as op
+import hashlib
+import json
+import pickle
+import shutil
+from collections import OrderedDict
+
+import numpy as np
+
+from mne.utils import get_config, logger
+
+# bump this whenever the layout of cache entries changes
+_CACHE_VERSION = 1
+# numeric arrays with fewer elements are stored inline in the header
+_INLINE_SIZE = 1024
+
+
+class _LRUCache(object):
+    """A minimal least-recently-used mapping"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        if key not in self._data:
+            return default
+        value = self._data.pop(key)
+        self._data[key] = value  # most recently used goes last
+        return value
+
+    def set(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+
+def get_cache_dir(cache_dir=None):
+    """Get the directory of the on-disk cache
+
+    Parameters
+    ----------
+    cache_dir : str | None
+        The cache directory. If None, the MNE config variable
+        ``MNE_HCP_CACHE_DIR`` is used. If that is not set either, no
+        on-disk cache is used.
+
+    Returns
+    -------
+    cache_dir : str | None
+        The cache directory, or None.
+    """
+    if cache_dir is None:
+        cache_dir = get_config('MNE_HCP_CACHE_DIR', None)
+    return cache_dir
+
+
+def _get_file_key(fname):
+    """helper to identify a file state by path, mtime and size"""
+    stat = os.stat(fname)
+    return (op.realpath(fname), stat.st_mtime, stat.st_size)
+
+
+def _hash_key(key):
+    """helper to turn a cache key into a file name"""
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+def _atomic_pickle(obj, fname):
+    """helper to write a pickle that never appears half written"""
+    tmp_fname = '%s.%d.tmp' % (fname, os.getpid())
+    with open(tmp_fname, 'wb') as fid:
+        pickle.dump(obj, fid, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_fname, fname)
+
+
+def _cached_call(fun, fname, memory, cache_dir, kind, extra_key=()):
+    """helper to memoize `fun(fname)` in memory and on disk
+
+    The entries are keyed on the path, mtime and size of `fname`, hence
+    they become stale as soon as the file changes. `extra_key` holds
+    further parameters `fun` depends on.
+    """
+    key = (kind,) + _get_file_key(fname) + tuple(extra_key)
+    out = memory.get(key)
+    if out is not None:
+        return out
+
+    cache_dir = get_cache_dir(cache_dir)
+    cache_fname = None
+    if cache_dir is not None:
+        cache_fname = op.join(cache_dir, '%s-%s.pkl' % (kind, _hash_key(key)))
+        if op.isfile(cache_fname):
+            logger.debug('reading %s from %s' % (kind, cache_fname))
+            with open(cache_fname, 'rb') as fid:
+                out = pickle.load(fid)
+
+    if out is None:
+        out = fun(fname)
+        if cache_fname is not None:
+            try:
+                if not op.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                _atomic_pickle(out, cache_fname)
+            except OSError as err:  # e.g., raced by another process
+                logger.warning('could not write %s: %s' % (cache_fname, err))
+
+    memory.set(key, out)
+    return out
+
+
+def _encode(obj, arrays):
+    """helper to turn reader outputs into JSON, collecting large arrays"""
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.names is not None:  # MATLAB struct from loadmat
+            records = obj.reshape(-1, 1)
+            return {'__record__': [
+                [name, [_encode(rec[name][0], arrays) for rec in records]]
+                for name in obj.dtype.names], 'shape': list(obj.shape)}
+        if obj.dtype == np.object_:
+            return {'__object__': [_encode(o, arrays) for o in obj.ravel()],
+                    'shape': list(obj.shape)}
+        if obj.dtype.kind in 'US':
+            return {'__object__': obj.ravel().tolist(),
+                    'shape': list(obj.shape)}
+        if obj.size < _INLINE_SIZE:
+            return {'__array__': obj.ravel().tolist(),
+                    'dtype': obj.dtype.str, 'shape': list(obj.shape)}
+        fname = 'array-%03d.npy' % len(arrays)
+        arrays.append((fname, obj))
+        return {'__npy__': fname}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, dict):
+        return {'__dict__': [[key, _encode(val, arrays)]
+                             for key, val in obj.items()]}
+    if isinstance(obj, (list, tuple)):
+        return [_encode(o, arrays) for o in obj]
+    return obj
+
+
+def _decode(obj, entry):
+    """helper to invert `_encode`, memory mapping the stored arrays"""
+    if isinstance(obj, list):
+        return [_decode(o, entry) for o in obj]
+    if not isinstance(obj, dict):
+        return obj
+    if '__npy__' in obj:
+        # copy on write: callers may modify the data, the cache stays intact
+        return np.load(op.join(entry, obj['__npy__']), mmap_mode='c')
+    if '__array__' in obj:
+        return np.array(obj['__array__'],
+                        dtype=obj['dtype']).reshape(obj['shape'])
+    if '__object__' in obj:
+        items = [_decode(o, entry) for o in obj['__object__']]
+        out = np.empty(len(items), dtype=np.object_)
+        for ii, item in enumerate(items):
+            out[ii] = item
+        return out.reshape(obj['shape'])
+    if '__record__' in obj:
+        fields = obj['__record__']
+        out = np.empty(int(np.prod(obj['shape'])),
+                       dtype=[(name, np.object_) for name, _ in fields])
+        for name, vals in fields:
+            for ii, val in enumerate(vals):
+                out[name][ii] = _decode(val, entry)
+        return out.reshape(obj['shape'])
+    return dict((key, _decode(val, entry)) for key, val in obj['__dict__'])
+
+
+def _read_cache_entry(entry, sources):
+    """helper to read a cache entry, None if missing or stale"""
+    header_fname = op.join(entry, 'header.json')
+    if not op.isfile(header_fname):
+        return None
+    with open(header_fname, 'r') as fid:
+        header = json.load(fid)
+    if header.get('version') != _CACHE_VERSION:
+        return None
+    if header['sources'] != [list(_get_file_key(s)) for s in sources]:
+        logger.info('cache entry %s is stale' % entry)
+        return None
+    return _decode(header['contents'], entry)
+
+
+def _write_cache_entry(entry, obj, sources):
+    """helper to write a cache entry as .npy arrays plus a JSON header
+
+    The entry is assembled in a temporary directory and moved in place,
+    hence readers never see partially written entries. If that fails,
+    e.g., because another process wrote the same entry meanwhile, the
+    temporary directory is removed and the error raised.
+    """
+    arrays = list()
+    header = dict(version=_CACHE_VERSION,
+                  sources=[list(_get_file_key(s)) for s in sources],
+                  contents=_encode(obj, arrays))
+    tmp_entry = '%s.%d.tmp' % (entry, os.getpid())
+    try:
+        if op.exists(tmp_entry):
+            shutil.rmtree(tmp_entry)
+        os.makedirs(tmp_entry)
+        for fname, array in arrays:
+            np.save(op.join(tmp_entry, fname), np.ascontiguousarray(array))
+        with open(op.join(tmp_entry, 'header.json'), 'w') as fid:
+            json.dump(header, fid)
+        if op.exists(entry):
+            old_entry = '%s.%d.old' % (entry, os.getpid())
+            os.rename(entry, old_entry)
+            shutil.rmtree(old_entry)
+        os.rename(tmp_entry, entry)
+    except OSError:
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        raise
+
+
+def _cached_entry(reader, sources, subject, kind, cache_dir, fill=True):
+    """helper to serve `reader()` from the persistent cache if fresh
+
+    Parameters
+    ----------
+    reader : callable
+        Reads the data from the HCP files, called on cache misses.
+    sources : list of str
+        The HCP files read by `reader`.
+    subject : str
+        The subject, used to group cache entries.
+    kind : str
+        The kind of data, e.g., 'epochs' or 'ica'.
+    cache_dir : str | None
+        The cache directory, see `get_cache_dir`.
+    fill : bool
+        Whether to call `reader` and write the entry if it is missing or
+        stale. If False, None is returned instead.
+
+    Failing to write an entry is logged, the data are returned anyway.
+    """
+    cache_dir = get_cache_dir(cache_dir)
+    if cache_dir is None:
+        return reader() if fill else None
+    entry = op.join(cache_dir, str(subject),
+                    '%s-%s' % (op.basename(sources[0]), kind))
+    out = _read_cache_entry(entry, sources)
+    if out is None and fill:
+        out = reader()
+        try:
+            _write_cache_entry(entry, out, sources)
+        except OSError as err:  # e.g., raced by another process
+            logger.warning('could not write cache entry %s: %s' % (
+                           entry, err))
+        else:
+            logger.info('wrote cache entry %s' % entry)
+    return out
+
+
+def build_cache_hcp(subject, data_types=('rest', 'task_working_memory',
+                                         'task_story_math', 'task_motor'),
+                    outputs=('epochs', 'trial_info', 'ica', 'annot'),
+                    hcp_path=op.curdir, cache_dir=None):
+    """Convert the preprocessed data of a subject into the binary cache
+
+    Once built, the readers, e.g., `read_epochs_hcp`, load the data
+    from the cache as long as the HCP files have not changed.
+
+    Parameters
+    ----------
+    subject : str
+        The subject.
+    data_types : list of str
+        The data types to convert. Defaults to all data types with
+        preprocessed data.
+    outputs : list of str
+        The outputs to convert. Defaults to
+        ('epochs', 'trial_info', 'ica', 'annot').
+    hcp_path : str
+        The HCP directory, defaults to op.curdir.
+    cache_dir : str | None
+        The cache directory. If None, the MNE config variable
+        ``MNE_HCP_CACHE_DIR`` is used.
+
+    Returns
+    -------
+    failed : list of tuple
+        The (data_type, run_index, output) combinations which could not be
+        converted, e.g., because files are missing or cannot be read.
+    """
+    from .file_mapping.file_mapping import run_map
+    from . import read
+
+    cache_dir = get_cache_dir(cache_dir)
+    if cache_dir is None:
+        raise ValueError('Please pass `cache_dir` or set the MNE config '
+                         'variable MNE_HCP_CACHE_DIR.')
+    readers = dict(epochs=read.read_epochs_hcp,
+                   trial_info=read.read_trial_info_hcp,
+                   ica=read.read_ica_hcp,
+                   annot=read.read_annot_hcp)
+    for output in outputs:
+        if output not in readers:
+            raise ValueError('`output` must be one of %s, got "%s".' % (
+                             ', '.join(sorted(readers)), output))
+    failed = list()
+    for data_type in data_types:
+        if 'noise' in data_type:
+            raise ValueError('HCP does not ship preprocessed data for "%s"'
+                             % data_type)
+        for run_index in range(len(run_map[data_type])):
+            for output in outputs:
+                if output == 'trial_info' and 'task' not in data_type:
+                    continue
+                logger.info('caching %s %s run %d %s' % (
+                            subject, data_type, run_index, output))
+                try:
+                    readers[output](subject=subject, data_type=data_type,
+                                    run_index=run_index, hcp_path=hcp_path,
+                                    cache_dir=cache_dir)
+                except Exception as err:  # list it, cache the others
+                    logger.warning('could not cache %s: %s' % (output, err))
+                    failed.append((data_type, run_index, output))
+    return failed
@@ -0,0 +1,241 @@
+# Author: Denis A. Engemann <denis.engemann@gmail.com>
+# License: BSD (3-clause)
+
+import os
+import os.path as op
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+from mne.utils import logger
+
+# large reads keep the number of requests per file low
+_CHUNK_SIZE = 8 * 1024 ** 2
+
+
+def _check_boto3():
+    """helper to import boto3 for S3 downloads"""
+    try:
+        import boto3
+    except ImportError:
+        raise ImportError('Downloading from S3 requires boto3, please '
+                          'install it.')
+    return boto3
+
+
+class LocalBackend(object):
+    """Serve bucket keys from a local directory
+
+    This mimics a bucket for testing and for data mirrored on a shared
+    file system.
+
+    Parameters
+    ----------
+    root : str
+        The directory holding the keys, or a ``file://`` URL.
+    """
+
+    def __init__(self, root):
+        if root.startswith('file://'):
+            root = root[len('file://'):]
+        self.root = root
+
+    def _fname(self, key):
+        return op.join(self.root, key)
+
+    def size(self, key):
+        """The size of a key in bytes"""
+        return os.stat(self._fname(key)).st_size
+
+    def md5(self, key):
+        """The MD5 hex digest of a key"""
+        md5 = hashlib.md5()
+        for chunk in self.iter_range(key):
+            md5.update(chunk)
+        return md5.hexdigest()
+
+    def stat(self, key, md5=True):
+        """The size and MD5 hex digest of a key, the latter None if not
+        `md5`, since computing it reads the whole file"""
+        return self.size(key), self.md5(key) if md5 else None
+
+    def iter_range(self, key, start=0, stop=None, chunk_size=_CHUNK_SIZE):
+        """Read the bytes from `start` to `stop` of a key in chunks"""
+        with open(self._fname(key), 'rb') as fid:
+            fid.seek(start)
+            remaining = None if stop is None else stop - start
+            while remaining is None or remaining > 0:
+                n_read = (chunk_size if remaining is None else
+                          min(chunk_size, remaining))
+                chunk = fid.read(n_read)
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+
+class S3Backend(object):
+    """Serve bucket keys from S3 or an S3 compatible store
+
+    Parameters
+    ----------
+    bucket : str
+        The bucket, e.g., 'hcp-openaccess'.
+    client : boto3 client | None
+        The client. If None, ``boto3.client('s3')`` is used, which reads
+        the credentials from the usual AWS configuration.
+    """
+
+    def __init__(self, bucket, client=None):
+        if client is None:
+            client = _check_boto3().client('s3')
+        self.bucket = bucket
+        self.client = client
+
+    def size(self, key):
+        """The size of a key in bytes"""
+        return self.stat(key, md5=False)[0]
+
+    def md5(self, key):
+        """The MD5 hex digest of a key, None if S3 does not know it"""
+        return self.stat(key)[1]
+
+    def stat(self, key, md5=True):
+        """The size and MD5 hex digest of a key from one HEAD request
+
+        The digest is None if S3 does not know it or if not `md5`.
+        """
+        head = self.client.head_object(Bucket=self.bucket, Key=key)
+        etag = head['ETag'].strip('"')
+        # multipart uploads have ETags like '<hash>-<n_parts>', not MD5s
+        if not md5 or '-' in etag:
+            etag = None
+        return head['ContentLength'], etag
+
+    def iter_range(self, key, start=0, stop=None, chunk_size=_CHUNK_SIZE):
+        """Read the bytes from `start` to `stop` of a key in chunks"""
+        if stop is not None and stop <= start:
+            return
+        byte_range = 'bytes=%d-%s' % (start, '' if stop is None else stop - 1)
+        response = self.client.get_object(Bucket=self.bucket, Key=key,
+                                          Range=byte_range)
+        for chunk in response['Body'].iter_chunks(chunk_size):
+            yield chunk
+
+
+def get_backend(url):
+    """Get the backend serving the keys under a URL
+
+    Parameters
+    ----------
+    url : str
+        Either ``s3://<bucket>``, ``file://<directory>`` or a directory.
+
+    Returns
+    -------
+    backend : instance of S3Backend | LocalBackend
+        The backend.
+    """
+    if url.startswith('s3://'):
+        return S3Backend(url[len('s3://'):].strip('/'))
+    return LocalBackend(url)
+
+
+def _download_key(backend, key, dest_dir, verify, chunk_size, stat=None,
+                  cancelled=None):
+    """helper to download one key, resuming partial downloads
+
+    `stat` is the (size, md5) of the key if known already, `cancelled` a
+    threading.Event which stops the download between chunks.
+    """
+    fname = op.join(dest_dir, key)
+    size, md5 = backend.stat(key, md5=verify) if stat is None else stat
+    if op.isfile(fname) and os.stat(fname).st_size == size:
+        logger.debug('%s is up to date' % key)
+        return fname
+
+    part_fname = fname + '.part'
+    if not op.isdir(op.dirname(fname)):
+        try:
+            os.makedirs(op.dirname(fname))
+        except OSError:  # created by another worker meanwhile
+            pass
+    start = 0
+    digest = hashlib.md5()
+    if op.isfile(part_fname):
+        start = os.stat(part_fname).st_size
+        if start > size:
+            start = 0
+        elif md5 is not None:
+            with open(part_fname, 'rb') as fid:
+                for chunk in iter(lambda: fid.read(chunk_size), b''):
+                    digest.update(chunk)
+    if start > 0:
+        logger.info('resuming %s at %d of %d bytes' % (key, start, size))
+    with open(part_fname, 'ab' if start > 0 else 'wb') as fid:
+        for chunk in backend.iter_range(key, start, size,
+                                        chunk_size=chunk_size):
+            if cancelled is not None and cancelled.is_set():
+                raise IOError('downloading %s was cancelled' % key)
+            fid.write(chunk)
+            if md5 is not None:
+                digest.update(chunk)
+
+    this_size = os.stat(part_fname).st_size
+    if this_size != size:
+        raise IOError('%s has %d bytes, expected %d' % (key, this_size, size))
+    if md5 is not None and digest.hexdigest() != md5:
+        os.remove(part_fname)  # corrupt, do not resume from it
+        raise IOError('%s failed the MD5 check' % key)
+    os.replace(part_fname, fname)
+    logger.info('downloaded %s' % key)
+    return fname
+
+
+def download_hcp_files(keys, backend, dest_dir, n_jobs=8, verify=True,
+                       chunk_size=_CHUNK_SIZE):
+    """Download files listed by the S3 key helpers concurrently
+
+    Files already present with the expected size are skipped and
+    interrupted downloads are resumed from their ``.part`` files, hence
+    calling this again completes an earlier run.
+
+    Parameters
+    ----------
+    keys : list of str
+        The keys, e.g., from `hcp.io.file_mapping.get_s3_keys_meg`.
+    backend : str | instance of S3Backend | LocalBackend
+        Where to download from, see `get_backend`.
+    dest_dir : str
+        The directory to download to, the files are stored under their
+        keys. With the default ``hcp_path_bucket='HCP_900'``, the HCP
+        directory is then ``op.join(dest_dir, 'HCP_900')``.
+    n_jobs : int
+        The number of concurrent downloads. Defaults to 8.
+    verify : bool
+        Whether to check the MD5 sums of the downloads where the backend
+        knows them. Sizes are always checked. Defaults to True.
+    chunk_size : int
+        The number of bytes to read per request. Defaults to 8 MB.
+
+    Returns
+    -------
+    failed : list of tuple
+        The (key, error) of the downloads which failed, the others are
+        done nonetheless.
+    """
+    if isinstance(backend, str):
+        backend = get_backend(backend)
+    keys = list(dict.fromkeys(keys))  # unique, ordered
+    failed = list()
+    with ThreadPoolExecutor(max_workers=max(n_jobs, 1)) as executor:
+        futures = [(key, executor.submit(_download_key, backend, key,
+                                         dest_dir, verify, chunk_size))
+                   for key in keys]
+        for key, future in futures:
+            try:
+                future.result()
+            except Exception as err:
+                logger.warning('downloading %s failed: %s' % (key, err))
+                failed.append((key, err))
+    return failed
@@ -1,3 +1,4 @@
-from . file_mapping import get_file_paths
+from . file_mapping import get_file_paths, get_subject_manifest
 from . s3 import get_s3_keys_meg
 from . s3 import get_s3_keys_anatomy
+from . index import scan_hcp_path, query_hcp_index, find_subjects_hcp
@@ -151,10 +151,165 @@ onset_map = {
 }
 
 
+# (data_type, output, processing, ...) -> paths split at the subject
+_path_table = dict()
+
+
 def get_file_paths(subject, data_type, output, processing, run_index=0,
                    onset='auto', conditions=(), diff_modes=(),
                    mode='full',
                    sensor_modes=(), hcp_path='.'):
+    """Synthesize the paths of the HCP files for a given data context
+
+    The paths are resolved once per combination of arguments other than
+    `subject` and `hcp_path` and stored in a table, later calls only fill
+    in the subject.
+
+    Parameters
+    ----------
+    subject : str
+        The subject.
+    data_type : str
+        The data type, e.g., 'rest', 'task_motor', 'meg_anatomy' or
+        'freesurfer'.
+    output : str
+        The output, e.g., 'meg_data', 'bads', 'ica', 'trial_info'.
+    processing : {'unprocessed', 'preprocessed'}
+        The processing stage.
+    run_index : int
+        The run index. Defaults to 0.
+    onset : {'auto', 'stim', 'resp'}
+        The onset of the epochs for preprocessed task data.
+    conditions, diff_modes, sensor_modes : tuple
+        The averaging context for evoked outputs.
+    mode : {'full', 'minimal'}
+        For freesurfer outputs, whether to list all files or only the
+        minimum needed by MNE.
+    hcp_path : str
+        The HCP directory, defaults to '.'. If a URL, e.g.,
+        's3://hcp-openaccess/HCP_900', the URLs of the files are returned.
+        Nothing is downloaded, the readers fetch the files they open
+        through the local store, see `hcp.io.get_store`.
+
+    Returns
+    -------
+    files : list of str
+        The file paths.
+    """
+    key = (data_type, output, processing, run_index, onset,
+           tuple(conditions), tuple(diff_modes), mode, tuple(sensor_modes))
+    templates = _path_table.get(key)
+    if templates is None:
+        templates = [
+            tuple(pa.split(_subject_placeholder)) for pa in
+            _synthesize_file_paths(
+                subject=_subject_placeholder, data_type=data_type,
+                output=output, processing=processing, run_index=run_index,
+                onset=onset, conditions=conditions, diff_modes=diff_modes,
+                mode=mode, sensor_modes=sensor_modes, hcp_path='')]
+        _path_table[key] = templates
+    subject = str(subject)
+    return [op.join(hcp_path, subject.join(parts)) for parts in templates]
+
+
+def get_subject_manifest(subject, hcp_path='.', mode='full'):
+    """List all files known to the file mapping for a subject
+
+    Covers the unprocessed and preprocessed MEG data of all runs (with
+    bads, ICA and trial info), the MEG anatomy and the freesurfer outputs.
+    Averaged outputs (evoked, tfr, psd) are not included.
+
+    Parameters
+    ----------
+    subject : str
+        The subject.
+    hcp_path : str
+        The HCP directory, defaults to '.'.
+    mode : {'full', 'minimal'}
+        Whether to list all freesurfer files or only the minimum needed by
+        MNE. Defaults to 'full'.
+
+    Returns
+    -------
+    manifest : list of dict
+        One entry per file with the keys 'fname', 'data_type', 'output',
+        'processing', 'run_index' (None for anatomy) and 'onset'.
+    """
+    templates = _path_table.get(('manifest', mode))
+    if templates is None:
+        templates = list()
+        for entry in _iter_manifest(mode):
+            fname = entry.pop('fname')
+            templates.append((tuple(fname.split(_subject_placeholder)),
+                              entry))
+        _path_table[('manifest', mode)] = templates
+    subject = str(subject)
+    manifest = list()
+    for parts, entry in templates:
+        entry = dict(entry)
+        entry['fname'] = op.join(hcp_path, subject.join(parts))
+        manifest.append(entry)
+    return manifest
+
+
+def _iter_manifest(mode):
+    """helper to generate the subject independent manifest"""
+    seen = set()
+
+    def _entries(data_type, output, processing, run_index=0, onset='auto'):
+        for fname in get_file_paths(
+                subject=_subject_placeholder, data_type=data_type,
+                output=output, processing=processing, run_index=run_index,
+                onset=onset, mode=mode, hcp_path=''):
+            if fname in seen:
+                continue
+            seen.add(fname)
+            yield dict(fname=fname, data_type=data_type, output=output,
+                       processing=processing,
+                       run_index=(run_index if run_map[data_type]
+                                  else None),
+                       onset=onset)
+
+    for data_type in [k for k in kind_map if run_map[k]]:
+        for run_index in range(len(run_map[data_type])):
+            for entry in _entries(data_type, 'meg_data', 'unprocessed',
+                                  run_index):
+                yield entry
+            if 'noise' in data_type:
+                continue
+            if data_type == 'task_story_math':
+                onsets = ('resp',)
+            elif 'task' in data_type:
+                onsets = ('stim', 'resp')
+            else:
+                onsets = ('auto',)
+            for onset in onsets:
+                for entry in _entries(data_type, 'meg_data', 'preprocessed',
+                                      run_index, onset):
+                    yield entry
+            outputs = ['bads', 'ica']
+            if 'task' in data_type:
+                outputs.append('trial_info')
+            for output in outputs:
+                for entry in _entries(data_type, output, 'preprocessed',
+                                      run_index):
+                    yield entry
+    for output in preprocessed['meg_anatomy']['patterns']:
+        for entry in _entries('meg_anatomy', output, 'preprocessed'):
+            yield entry
+    for output in preprocessed['freesurfer']['patterns']:
+        for entry in _entries('freesurfer', output, 'preprocessed'):
+            yield entry
+
+
+_subject_placeholder = '\x00subject\x00'
+
+
+def _synthesize_file_paths(subject, data_type, output, processing,
+                           run_index=0, onset='auto', conditions=(),
+                           diff_modes=(), mode='full', sensor_modes=(),
+                           hcp_path='.'):
+    """helper to build the file paths, see `get_file_paths`"""
     if data_type not in kind_map:
         raise ValueError('I never heard of `%s` -- are you sure this is a'
                          ' valid HCP type? I currenlty support:\n%s' % (
@@ -199,7 +354,8 @@ def get_file_paths(subject, data_type, output, processing, run_index=0,
             pattern_key = output
 
         my_pattern = file_map['patterns'][pattern_key]
-        if data_type == 'task_story_math':  # story math has only resp
+        if (data_type == 'task_story_math' and
+                output == 'meg_data'):  # story math has only resp
             my_pattern = [pp for pp in my_pattern if 'TRESP.mat' in pp]
 
         if output in ('bads', 'ica'):
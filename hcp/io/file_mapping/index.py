@@ -0,0 +1,215 @@
+# Author: Denis A. Engemann <denis.engemann@gmail.com>
+# License: BSD (3-clause)
+
+import os
+import os.path as op
+import sqlite3
+from collections import defaultdict
+
+from mne.utils import logger
+
+from .file_mapping import get_subject_manifest
+
+_schema = """
+CREATE TABLE IF NOT EXISTS files (
+    fname TEXT PRIMARY KEY,
+    subject TEXT,
+    data_type TEXT,
+    output TEXT,
+    processing TEXT,
+    run_index INTEGER,
+    onset TEXT,
+    present INTEGER,
+    size INTEGER,
+    mtime REAL);
+CREATE INDEX IF NOT EXISTS files_subject ON files (subject);
+CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime REAL);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+# the columns requirements and queries may refer to
+_query_fields = ('subject', 'data_type', 'output', 'processing',
+                 'run_index', 'onset')
+
+
+def _list_subjects(hcp_path):
+    """helper to find the subject directories of an HCP tree"""
+    return sorted(d for d in os.listdir(hcp_path)
+                  if d.isdigit() and op.isdir(op.join(hcp_path, d)))
+
+
+def scan_hcp_path(hcp_path, index_fname, subjects=None, mode='full'):
+    """Record the state of all known HCP files in an SQLite index
+
+    For every file of `get_subject_manifest`, the index stores whether it
+    exists, its size and its mtime. Directories are listed once instead
+    of calling stat for each file. When scanning again, directories
+    whose mtime did not change are skipped, hence only added or removed
+    files are picked up, not files modified in place.
+
+    Parameters
+    ----------
+    hcp_path : str
+        The HCP directory.
+    index_fname : str
+        The SQLite file, created if it does not exist.
+    subjects : list of str | None
+        The subjects to scan. If None, all directories of `hcp_path` whose
+        names are numbers are scanned.
+    mode : {'full', 'minimal'}
+        Whether to track all freesurfer files or only the minimum needed
+        by MNE. Defaults to 'full'.
+
+    Returns
+    -------
+    n_scanned : int
+        The number of directories listed, the others were up to date.
+    """
+    if subjects is None:
+        subjects = _list_subjects(hcp_path)
+    n_scanned = 0
+    con = sqlite3.connect(index_fname)
+    try:
+        with con:
+            con.executescript(_schema)
+            con.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                        ('hcp_path', op.realpath(hcp_path)))
+            dir_mtimes = dict(con.execute('SELECT path, mtime FROM dirs'))
+            for subject in subjects:
+                by_dir = defaultdict(list)
+                for entry in get_subject_manifest(subject, hcp_path='',
+                                                  mode=mode):
+                    by_dir[op.dirname(entry['fname'])].append(entry)
+                for rel_dir, entries in by_dir.items():
+                    abs_dir = op.join(hcp_path, rel_dir)
+                    try:
+                        mtime = os.stat(abs_dir).st_mtime
+                    except OSError:
+                        mtime = None
+                    if rel_dir in dir_mtimes and \
+                            dir_mtimes[rel_dir] == mtime:
+                        continue
+                    n_scanned += 1
+                    stats = dict()
+                    if mtime is not None:
+                        for dir_entry in os.scandir(abs_dir):
+                            if dir_entry.is_file():
+                                stat = dir_entry.stat()
+                                stats[dir_entry.name] = (stat.st_size,
+                                                         stat.st_mtime)
+                    rows = list()
+                    for entry in entries:
+                        size, file_mtime = stats.get(
+                            op.basename(entry['fname']), (None, None))
+                        rows.append((
+                            entry['fname'], str(subject), entry['data_type'],
+                            entry['output'], entry['processing'],
+                            entry['run_index'], entry['onset'],
+                            int(size is not None), size, file_mtime))
+                    con.executemany('INSERT OR REPLACE INTO files VALUES '
+                                    '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                    con.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)',
+                                (rel_dir, mtime))
+    finally:
+        con.close()
+    logger.info('scanned %d directories of %d subjects' % (
+                n_scanned, len(subjects)))
+    return n_scanned
+
+
+def _check_fields(fields):
+    """helper to only let known columns into SQL statements"""
+    unknown = set(fields) - set(_query_fields)
+    if unknown:
+        raise ValueError('Unknown fields %s, valid fields are: %s' % (
+                         ', '.join(sorted(unknown)), ', '.join(_query_fields)))
+
+
+def query_hcp_index(index_fname, present=True, **filters):
+    """List files recorded in an index
+
+    Parameters
+    ----------
+    index_fname : str
+        The SQLite file written by `scan_hcp_path`.
+    present : bool | None
+        If True (default), only existing files are listed, if False only
+        missing files, if None all files.
+    **filters : dict
+        Values the files must match, any of 'subject', 'data_type',
+        'output', 'processing', 'run_index' and 'onset'.
+
+    Returns
+    -------
+    files : list of dict
+        The files with the keys 'fname' (including the HCP directory),
+        'present', 'size' and 'mtime', plus the fields above.
+    """
+    _check_fields(filters)
+    clauses = ['%s = ?' % key for key in filters]
+    params = list(filters.values())
+    if present is not None:
+        clauses.append('present = ?')
+        params.append(int(present))
+    sql = 'SELECT * FROM files'
+    if clauses:
+        sql += ' WHERE ' + ' AND '.join(clauses)
+    con = sqlite3.connect(index_fname)
+    try:
+        con.row_factory = sqlite3.Row
+        hcp_path = con.execute(
+            "SELECT value FROM meta WHERE key = 'hcp_path'").fetchone()[0]
+        files = [dict(row) for row in con.execute(sql + ' ORDER BY fname',
+                                                  params)]
+    finally:
+        con.close()
+    for this_file in files:
+        this_file['fname'] = op.join(hcp_path, this_file['fname'])
+        this_file['present'] = bool(this_file['present'])
+    return files
+
+
+def find_subjects_hcp(index_fname, requirements):
+    """Find the subjects for which all required files exist
+
+    Parameters
+    ----------
+    index_fname : str
+        The SQLite file written by `scan_hcp_path`.
+    requirements : list of dict
+        Each requirement selects files by the values of any of
+        'data_type', 'output', 'processing', 'run_index' and 'onset'. A
+        subject is returned if all files it is expected to have according
+        to any requirement exist. For example, all task_motor runs plus
+        the MEG anatomy::
+
+            [dict(data_type='task_motor', processing='unprocessed'),
+             dict(data_type='meg_anatomy')]
+
+    Returns
+    -------
+    subjects : list of str
+        The subjects.
+    """
+    if not requirements:
+        raise ValueError('Please pass at least one requirement.')
+    clauses, params = list(), list()
+    for requirement in requirements:
+        if not requirement:
+            raise ValueError('Requirements must select files by at least '
+                             'one field, got an empty requirement.')
+        _check_fields(requirement)
+        clauses.append('(%s)' % ' AND '.join(
+            '%s = ?' % key for key in requirement))
+        params.extend(requirement.values())
+    condition = ' OR '.join(clauses)
+    sql = ('SELECT subject FROM files GROUP BY subject HAVING '
+           'SUM(CASE WHEN (%s) AND present = 0 THEN 1 ELSE 0 END) = 0 AND '
+           'SUM(CASE WHEN (%s) THEN 1 ELSE 0 END) > 0 ORDER BY subject' % (
+               condition, condition))
+    con = sqlite3.connect(index_fname)
+    try:
+        subjects = [row[0] for row in con.execute(sql, params * 2)]
+    finally:
+        con.close()
+    return subjects
@@ -0,0 +1,201 @@
+# Author: Denis A. Engemann <denis.engemann@gmail.com>
+# License: BSD (3-clause)
+
+import asyncio
+import os
+import os.path as op
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from mne.utils import logger
+
+from .download import get_backend, _download_key, _CHUNK_SIZE
+from .file_mapping import get_s3_keys_meg
+
+
+class _Prefetcher(object):
+    """Stage the files of upcoming subjects on an event loop thread"""
+
+    def __init__(self, subjects, keys_fun, backend, dest_dir, n_ahead,
+                 max_bytes, n_jobs, verify, chunk_size):
+        self.subjects = subjects
+        self.keys_fun = keys_fun
+        self.backend = backend
+        self.dest_dir = dest_dir
+        self.n_ahead = n_ahead
+        self.max_bytes = max_bytes
+        self.verify = verify
+        self.chunk_size = chunk_size
+        self.n_staged = 0  # subjects staged or in use, not yet released
+        self.staged_bytes = 0
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=max(n_jobs, 1))
+        self.cancelled = threading.Event()  # stops running downloads
+        self.loop.set_default_executor(self.executor)
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+
+    def _has_room(self, n_bytes):
+        """helper for the back-pressure, always let one subject through"""
+        if self.n_staged == 0:
+            return True
+        if self.n_staged > self.n_ahead:  # the current one plus n_ahead
+            return False
+        return (self.max_bytes is None or
+                self.staged_bytes + n_bytes <= self.max_bytes)
+
+    async def _stage(self, subject):
+        keys = self.keys_fun(subject)
+        run = self.loop.run_in_executor
+        # one request per key for the size and MD5, reused by the download
+        stats = await asyncio.gather(
+            *[run(None, self.backend.stat, key, self.verify) for key in keys],
+            return_exceptions=True)
+        n_bytes = sum(stat[0] for stat in stats if not isinstance(stat,
+                                                                  Exception))
+        async with self.condition:
+            await self.condition.wait_for(lambda: self._has_room(n_bytes))
+            self.n_staged += 1
+            self.staged_bytes += n_bytes
+        logger.info('staging %s (%d files, %d bytes)' % (
+                    subject, len(keys), n_bytes))
+        failed = [(key, stat) for key, stat in zip(keys, stats)
+                  if isinstance(stat, Exception)]
+        found = [(key, stat) for key, stat in zip(keys, stats)
+                 if not isinstance(stat, Exception)]
+        results = await asyncio.gather(
+            *[run(None, _download_key, self.backend, key, self.dest_dir,
+                  self.verify, self.chunk_size, stat, self.cancelled)
+              for key, stat in found],
+            return_exceptions=True)
+        failed += [(key, result) for (key, _), result in zip(found, results)
+                   if isinstance(result, Exception)]
+        return subject, keys, n_bytes, failed
+
+    async def _produce(self):
+        self.task = asyncio.current_task()
+        self.condition = asyncio.Condition()
+        self.queue = asyncio.Queue()
+        self.started.set()
+        try:
+            for subject in self.subjects:
+                await self.queue.put(await self._stage(subject))
+        except Exception as err:
+            await self.queue.put(err)
+        else:
+            await self.queue.put(None)
+
+    async def _release(self, n_bytes):
+        async with self.condition:
+            self.n_staged -= 1
+            self.staged_bytes -= n_bytes
+            self.condition.notify_all()
+
+    async def _cancel(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+    def _call(self, coro):
+        """helper to run a coroutine on the loop and wait for it"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def __iter__(self):
+        self.started = threading.Event()
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._produce(), self.loop)
+        self.started.wait()
+        try:
+            while True:
+                item = self._call(self.queue.get())
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                subject, keys, n_bytes, failed = item
+                yield subject, keys, failed
+                self._call(self._release(n_bytes))
+        finally:
+            # stop the downloads and wait for them while the loop runs,
+            # such that no thread writes or calls back into a closed loop
+            self.cancelled.set()
+            self._call(self._cancel())
+            self.executor.shutdown(wait=True)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+
+
+def prefetch_hcp_subjects(subjects, data_types, backend, dest_dir,
+                          n_ahead=2, max_bytes=None, n_jobs=8, delete=False,
+                          verify=True, chunk_size=_CHUNK_SIZE,
+                          hcp_path_bucket='HCP_900', **kwargs):
+    """Iterate subjects while the files of the next ones are downloaded
+
+    Downloads run on an asyncio event loop in a background thread. While
+    a subject is processed, the files of up to `n_ahead` further subjects
+    are staged in `dest_dir`, as long as they fit into `max_bytes`.
+
+    Parameters
+    ----------
+    subjects : list of str
+        The subjects.
+    data_types : list of str
+        The data types, see `hcp.io.file_mapping.get_s3_keys_meg`.
+    backend : str | instance of S3Backend | LocalBackend
+        Where to download from, see `hcp.io.get_backend`.
+    dest_dir : str
+        The directory to download to, see `hcp.io.download_hcp_files`.
+    n_ahead : int
+        The number of subjects to stage ahead of the current one.
+        Defaults to 2.
+    max_bytes : int | None
+        The maximum number of bytes staged, including the current
+        subject. A subject larger than that is staged on its own. If
+        None, only `n_ahead` limits the staging.
+    n_jobs : int
+        The number of concurrent downloads. Defaults to 8.
+    delete : bool
+        Whether to delete the files of a subject once the next one is
+        requested. Defaults to False.
+    verify : bool
+        Whether to check the MD5 sums of the downloads, see
+        `hcp.io.download_hcp_files`. Defaults to True.
+    chunk_size : int
+        The number of bytes to read per request. Defaults to 8 MB.
+    hcp_path_bucket : str
+        The top level directory of the keys. Defaults to 'HCP_900'.
+    **kwargs : dict
+        Further arguments passed to `get_s3_keys_meg`, e.g., `outputs`
+        or `run_inds`.
+
+    Returns
+    -------
+    subjects : generator
+        Yields tuples of (subject, hcp_path, failed), where `failed` lists
+        the (key, error) of downloads which failed. The files of the
+        subject are in place when it is yielded.
+    """
+    if isinstance(backend, str):
+        backend = get_backend(backend)
+    if n_ahead < 0:
+        raise ValueError('`n_ahead` must not be negative, got %s.' % n_ahead)
+
+    def keys_fun(subject):
+        return get_s3_keys_meg(subject, data_types,
+                               hcp_path_bucket=hcp_path_bucket, **kwargs)
+
+    prefetcher = _Prefetcher(
+        subjects, keys_fun, backend, dest_dir, n_ahead=n_ahead,
+        max_bytes=max_bytes, n_jobs=n_jobs, verify=verify,
+        chunk_size=chunk_size)
+    hcp_path = op.join(dest_dir, hcp_path_bucket)
+    for subject, keys, failed in prefetcher:
+        yield subject, hcp_path, failed
+        if delete:
+            for key in keys:
+                fname = op.join(dest_dir, key)
+                if op.isfile(fname):
+                    os.remove(fname)
@@ -1,9 +1,13 @@
 # Author: Denis A. Engemann <denis.engemann@gmail.com>
 # License: BSD (3-clause)
 
+import os
 import os.path as op
+import hashlib
+import io
 import itertools as itt
 import re
+from functools import partial
 
 import numpy as np
 import scipy.io as scio
@@ -12,27 +16,68 @@ from scipy import linalg
 from mne import EpochsArray, pick_info
 from mne.transforms import apply_trans
 from mne.io.bti.bti import _get_bti_info, read_raw_bti
-from mne.io import _loc_to_coil_trans
+from mne.io import _loc_to_coil_trans, RawArray
 
 from .file_mapping import get_file_paths
+from .cache import _LRUCache, _cached_call, _cached_entry, get_cache_dir
+from .store import get_store, pin_remote, _split_url, _local_files
 
+_info_cache = _LRUCache(max_size=256)
 
-def _parse_trans(string):
-    """helper to parse transforms"""
-    return np.array(string.replace('\n', '')
-                          .strip('[] ')
-                          .split(' '), dtype=float).reshape(4, 4)
+
+# one MATLAB assignment, e.g., `badsegment.all = [1 2\n 3 4];`
+_assignment_re = re.compile(r"""
+    (?P<name>[A-Za-z_][\w.]*)\s*=\s*
+    (?P<value>\[[^\]]*\]     # numeric array
+             |\{[^}]*\}       # cell array of strings
+             |'[^']*'         # string
+             |[^;\n]*)        # scalar
+    \s*;""", re.VERBOSE)
+_quoted_re = re.compile(r"'([^']*)'")
+
+
+def _parse_assignments(string):
+    """helper to tokenize the HCP text files in one pass
+
+    Parameters
+    ----------
+    string : str
+        The file contents, a sequence of `name.field = value;` statements.
+
+    Returns
+    -------
+    out : list of tuple
+        The (field, kind, value) of each statement in order of appearance.
+        The kind is one of 'array', 'cell', 'str' or 'scalar'. Cells are
+        returned as lists of str, the other kinds as str without brackets
+        or quotes.
+    """
+    out = list()
+    for match in _assignment_re.finditer(string):
+        field = match.group('name').split('.', 1)[-1]
+        value = match.group('value')
+        if value.startswith('['):
+            out.append((field, 'array', value[1:-1]))
+        elif value.startswith('{'):
+            out.append((field, 'cell', _quoted_re.findall(value)))
+        elif value.startswith("'"):
+            out.append((field, 'str', value[1:-1]))
+        else:
+            out.append((field, 'scalar', value.strip()))
+    return out
+
+
+def _to_array(value, dtype):
+    """helper to convert the body of a numeric array to numpy"""
+    return np.array(value.replace(',', ' ').split(), dtype=dtype)
 
 
 def _parse_hcp_trans(fid, transforms, convert_to_meter):
     """" another helper """
-    contents = fid.read()
-    for trans in contents.split(';'):
-        if 'filename' in trans or trans == '\n':
+    for key, _, trans in _parse_assignments(fid.read()):
+        if key == 'filename':
             continue
-        key, trans = trans.split(' = ')
-        key = key.lstrip('\ntransform.')
-        transforms[key] = _parse_trans(trans)
+        transforms[key] = _to_array(trans, float).reshape(4, 4)
         if convert_to_meter:
             transforms[key][:3, 3] *= 1e-3  # mm to m
     if not transforms:
@@ -53,17 +98,11 @@ def _read_landmarks_hcp(fname):
     """ XXX parse landmarks currently not used """
     out = dict()
     with open(fname) as fid:
-        for line in fid:
-            kind, data = line.split(' = ')
-            kind = kind.split('.')[1]
+        for kind, _, data in _parse_assignments(fid.read()):
             if kind == 'coordsys':
-                out['coord_frame'] = data.split(';')[0].replace("'", "")
+                out['coord_frame'] = data
             else:
-                data = data.split()
-                for c in ('[', '];'):
-                    if c in data:
-                        data.remove(c)
-                out[kind] = np.array(data, dtype=int) * 1e-3  # mm to m
+                out[kind] = _to_array(data, int) * 1e-3  # mm to m
     return out
 
 
@@ -76,24 +115,180 @@ def _get_head_model(head_model_fname):
     return pnts, faces
 
 
+def _read_bti_header(raw_fid, config):
+    """ helper to access bti info and data layout from pdf and config """
+    with _local_files([config]) as (config,):
+        info, bti_info = _get_bti_info(
+            pdf_fname=raw_fid, config_fname=config, head_shape_fname=None,
+            rotation_x=0.0, translation=(0.0, 0.02, 0.11),
+            ecg_ch='E31', eog_ch=('E63', 'E64'),
+            convert=False,  # no conversion to neuromag coordinates
+            rename_channels=False,  # keep native channel names
+            sort_by_ch_name=False)  # do not change native order
+    return info, bti_info
+
+
 def _read_bti_info(zf, config):
     """ helper to only access bti info from pdf file """
-    raw_fid = None
-    info, bti_info = _get_bti_info(
-        pdf_fname=raw_fid, config_fname=config, head_shape_fname=None,
-        rotation_x=0.0, translation=(0.0, 0.02, 0.11),
-        ecg_ch='E31', eog_ch=('E63', 'E64'),
-        convert=False,  # no conversion to neuromag coordinates
-        rename_channels=False,  # keep native channel names
-        sort_by_ch_name=False)  # do not change native order
+    info, _ = _read_bti_header(None, config)
     return info
 
 
-def _read_raw_bti(raw_fid, config_fid, convert):
+def _scale_bti_data(samples, info, bti_info, picks):
+    """ helper to pick and calibrate channels of pdf samples
+
+    `samples` holds rows of `total_chans` values as stored in the file.
+    """
+    columns = np.asarray(bti_info['order'])[picks]
+    read_cals = np.empty(bti_info['total_chans'])
+    for ch in bti_info['chs']:
+        read_cals[ch['index']] = ch['cal']
+    cals = np.array([info['chs'][pick]['cal'] * info['chs'][pick]['range']
+                     for pick in picks])
+    data = samples[:, columns].T.astype(np.float64)
+    data *= (read_cals[columns] * cals)[:, np.newaxis]
+    return data
+
+
+def _read_bti_data(raw_fid, info, bti_info, start, stop, picks):
+    """ helper to read a sample range of some channels from a pdf file
+
+    The pdf file stores samples as rows of `total_chans` values, hence
+    only the bytes of the rows from `start` to `stop` are accessed.
+    """
+    samples = np.memmap(raw_fid, dtype=bti_info['dtype'], mode='r',
+                        shape=(bti_info['total_slices'],
+                               bti_info['total_chans']))
+    data = _scale_bti_data(samples[start:stop], info, bti_info, picks)
+    del samples
+    return data
+
+
+def _read_bti_data_remote(store, key, info, bti_info, start, stop, picks):
+    """ helper to read a sample range of a remote pdf file by byte range
+
+    Samples start at the beginning of the file, hence the rows from
+    `start` to `stop` are fetched with one ranged request.
+    """
+    dtype = np.dtype(bti_info['dtype'])
+    bytes_per_slice = dtype.itemsize * bti_info['total_chans']
+    buf = b''.join(store.backend.iter_range(
+        key, start * bytes_per_slice, stop * bytes_per_slice))
+    samples = np.frombuffer(buf, dtype=dtype).reshape(
+        -1, bti_info['total_chans'])
+    return _scale_bti_data(samples, info, bti_info, picks)
+
+
+def _locate_bti_header(tail, size):
+    """ helper to find the header of a pdf file from its last 8 bytes
+
+    This follows MNE's reading of the pdf header.
+    """
+    file_mask = 2147483647
+    start = size - 8
+    header_position = int(np.frombuffer(tail, '>u8')[0])
+    check_value = header_position & file_mask
+    if start + 8 - check_value <= file_mask:
+        header_position = check_value
+    if header_position % 8 != 0:  # alignment
+        header_position += 8 - header_position % 8
+    return header_position
+
+
+class _BtiHeaderIO(io.BytesIO):
+    """ The header of a pdf file, addressed by its offsets in the file
+
+    MNE seeks to the header at its absolute position and reads it from
+    there. This mimics the file with the header bytes only.
+    """
+
+    def __init__(self, header, header_position):
+        io.BytesIO.__init__(self, header)
+        self.header_position = header_position
+
+    def seek(self, pos, whence=0):
+        if whence == 0:
+            pos -= self.header_position
+        return io.BytesIO.seek(self, pos, whence) + self.header_position
+
+    def tell(self):
+        return io.BytesIO.tell(self) + self.header_position
+
+
+def _fetch_bti_header(store, key):
+    """ helper to fetch the header of a remote pdf file
+
+    The header sits at the end of the pdf file. Its bytes are kept in the
+    store directory under the key and the size of the file, hence a
+    changed file is fetched again. Headers take a few kB each and are
+    not subject to the quota of the store.
+    """
+    size = store.backend.size(key)
+    fname = op.join(store.root, 'headers', '%s-%d' % (
+        hashlib.sha1(key.encode('utf-8')).hexdigest(), size))
+    if op.isfile(fname):
+        with open(fname, 'rb') as fid:
+            header = fid.read()
+        return _BtiHeaderIO(header, size - len(header))
+    tail = b''.join(store.backend.iter_range(key, size - 8, size))
+    header_position = _locate_bti_header(tail, size)
+    header = b''.join(store.backend.iter_range(key, header_position, size))
+    if not op.isdir(op.dirname(fname)):
+        try:
+            os.makedirs(op.dirname(fname))
+        except OSError:  # created by another process meanwhile
+            pass
+    tmp_fname = '%s.%d.tmp' % (fname, os.getpid())
+    with open(tmp_fname, 'wb') as fid:
+        fid.write(header)
+    os.replace(tmp_fname, fname)
+    return _BtiHeaderIO(header, header_position)
+
+
+def _get_raw_paths(subject, data_type, run_index, hcp_path):
+    """ helper to find the pdf and config files without reading samples
+
+    For remote data, see `hcp.io.get_store`, only the header of the pdf
+    file is fetched, `_read_bti_header` fetches the config file.
+
+    Returns
+    -------
+    pdf : str | file-like
+        The pdf file, or its header if remote.
+    config : str
+        The config file, a URL if remote.
+    read_data : callable
+        Reads samples like `_read_bti_data` without the pdf argument.
+    """
+    pdf, config = get_file_paths(
+        subject=subject, data_type=data_type, output='meg_data',
+        run_index=run_index, processing='unprocessed', hcp_path=hcp_path)
+    if '://' not in hcp_path:
+        return pdf, config, partial(_read_bti_data, pdf)
+    store = get_store(pdf)
+    key = _split_url(pdf)[1]
+    return (_fetch_bti_header(store, key), config,
+            partial(_read_bti_data_remote, store, key))
+
+
+def _time_to_samples(tmin, tmax, sfreq, n_times):
+    """ helper to convert a time window to a sample range """
+    start = 0 if tmin is None else int(round(tmin * sfreq))
+    stop = n_times if tmax is None else int(round(tmax * sfreq)) + 1
+    if start < 0 or start >= n_times:
+        raise ValueError('`tmin` (%s) must be within the recording, which '
+                         'lasts %0.3f s.' % (tmin, (n_times - 1) / sfreq))
+    if stop <= start:
+        raise ValueError('`tmax` (%s) must be larger than `tmin` (%s).' % (
+                         tmax, tmin))
+    return start, min(stop, n_times)
+
+
+def _read_raw_bti(raw_fid, config_fid, convert, preload=True):
     """Convert and raw file from HCP input"""
     raw = read_raw_bti(
         raw_fid, config_fid, convert=convert, head_shape_fname=None,
-        sort_by_ch_name=False, rename_channels=False, preload=True)
+        sort_by_ch_name=False, rename_channels=False, preload=preload)
 
     return raw
 
@@ -130,7 +325,8 @@ def _check_infos_trans(infos):
         np.testing.assert_array_almost_equal(ct1, ct2, 12)
 
 
-def read_raw_hcp(subject, data_type, run_index=0, hcp_path=op.curdir):
+def read_raw_hcp(subject, data_type, run_index=0, hcp_path=op.curdir,
+                 preload=True, picks=None, tmin=None, tmax=None):
     """ Read HCP raw data
 
     Parameters
@@ -151,24 +347,136 @@ def read_raw_hcp(subject, data_type, run_index=0, hcp_path=op.curdir):
         type.
     hcp_path : str
         The HCP directory, defaults to op.curdir.
+    preload : bool | str
+        If True (default), all data are loaded into memory. If False, the
+        4D file is left on disk and samples are only read when they are
+        accessed, e.g., via ``raw[picks, start:stop]``. If a string, data
+        are preloaded into a memory-mapped array stored in the file of
+        that name (which must be on a disk with enough free space).
+        Ignored if any of `picks`, `tmin` or `tmax` is given.
+    picks : array-like of int | None
+        The channels to read. If None, all channels are read.
+    tmin : float | None
+        The start of the time window to read in seconds, relative to the
+        beginning of the recording. If None, reading starts with the first
+        sample.
+    tmax : float | None
+        The end of the time window to read in seconds (included). If None,
+        reading stops with the last sample.
 
     Returns
     -------
     raw : instance of mne.io.Raw
-        The MNE raw object.
+        The MNE raw object. If any of `picks`, `tmin` or `tmax` is given,
+        only the selected samples and channels are read from disk and
+        returned preloaded. If moreover `hcp_path` is a URL, only the
+        bytes of the selected samples are downloaded.
     """
-    pdf, config = get_file_paths(
-        subject=subject, data_type=data_type,
-        output='meg_data',
-        run_index=run_index, processing='unprocessed', hcp_path=hcp_path)
-
-    raw = _read_raw_bti(pdf, config, convert=False)
+    if picks is None and tmin is None and tmax is None:
+        pdf, config = get_file_paths(
+            subject=subject, data_type=data_type,
+            output='meg_data',
+            run_index=run_index, processing='unprocessed', hcp_path=hcp_path)
+        if '://' not in hcp_path:
+            return _read_raw_bti(pdf, config, convert=False, preload=preload)
+        pins = [pin_remote(pdf), pin_remote(config)]
+        raw = _read_raw_bti(pins[0].fname, pins[1].fname, convert=False,
+                            preload=preload)
+        if preload is False:  # the raw reopens the file, keep it stored
+            raw._hcp_pins = pins
+        else:
+            for pin in pins:
+                pin.close()
+    else:
+        pdf, config, read_data = _get_raw_paths(
+            subject, data_type, run_index, hcp_path)
+        info, bti_info = _read_bti_header(pdf, config)
+        if picks is None:
+            picks = np.arange(info['nchan'])
+        picks = np.atleast_1d(picks)
+        start, stop = _time_to_samples(
+            tmin, tmax, info['sfreq'], bti_info['total_slices'])
+        data = read_data(info, bti_info, start, stop, picks)
+        raw = RawArray(data, pick_info(info, picks, copy=True),
+                       first_samp=start)
     return raw
 
 
-def read_info_hcp(subject, data_type, run_index=0, hcp_path=op.curdir):
+def iter_raw_hcp(subject, data_type, run_index=0, hcp_path=op.curdir,
+                 chunk_duration=10., overlap=0., picks=None):
+    """ Iterate over HCP raw data in blocks of fixed duration
+
+    The 4D file is opened lazily and only one block is held in memory at
+    a time. If `hcp_path` is a URL, each block is downloaded by a ranged
+    request.
+
+    Parameters
+    ----------
+    subject : str, file_map
+        The subject
+    data_type : str
+        The kind of data to read. The following options are supported:
+        'rest'
+        'task_motor'
+        'task_story_math'
+        'task_working_memory'
+        'noise_empty_room'
+        'noise_subject'
+    run_index : int
+        The run index. For the first run, use 0, for the second, use 1.
+        Also see HCP documentation for the number of runs for a given data
+        type.
+    hcp_path : str
+        The HCP directory, defaults to op.curdir.
+    chunk_duration : float
+        The duration of each block in seconds. Defaults to 10. The last
+        block may be shorter.
+    overlap : float
+        The duration in seconds shared by two consecutive blocks, e.g.,
+        to absorb filter edge effects. Must be smaller than
+        `chunk_duration`. Defaults to 0.
+    picks : array-like of int | None
+        The channels to read. If None, all channels are read.
+
+    Returns
+    -------
+    chunks : generator
+        Yields tuples of (data, start), where data is an array of shape
+        (n_channels, n_times) and start is the index of its first sample
+        relative to the beginning of the recording.
+    """
+    if overlap < 0 or overlap >= chunk_duration:
+        raise ValueError('`overlap` must be >= 0 and smaller than '
+                         '`chunk_duration`, got %s and %s.' % (
+                             overlap, chunk_duration))
+    pdf, config, read_data = _get_raw_paths(
+        subject, data_type, run_index, hcp_path)
+    info, bti_info = _read_bti_header(pdf, config)
+    if picks is None:
+        picks = np.arange(info['nchan'])
+    picks = np.atleast_1d(picks)
+    sfreq = info['sfreq']
+    n_times = bti_info['total_slices']
+    n_chunk = int(round(chunk_duration * sfreq))
+    n_step = n_chunk - int(round(overlap * sfreq))
+    if n_step < 1:
+        raise ValueError('`chunk_duration` and `overlap` leave no samples '
+                         'to advance at a sampling rate of %s Hz.' % sfreq)
+    for start in range(0, n_times, n_step):
+        stop = min(start + n_chunk, n_times)
+        data = read_data(info, bti_info, start, stop, picks)
+        yield data, start
+        if stop == n_times:
+            break
+
+
+def read_info_hcp(subject, data_type, run_index=0, hcp_path=op.curdir,
+                  cache_dir=None):
     """Read info from unprocessed data
 
+    The parsed info is memoized per config file (path, mtime and size),
+    so repeated calls for the same run do not parse the config again.
+
     Parameters
     ----------
     subject : str, file_map
@@ -187,23 +495,30 @@ def read_info_hcp(subject, data_type, run_index=0, hcp_path=op.curdir):
         type.
     hcp_path : str
         The HCP directory, defaults to op.curdir.
+    cache_dir : str | None
+        A directory in which parsed infos are additionally pickled, e.g.,
+        to share them across processes and sessions. If None, the MNE
+        config variable ``MNE_HCP_CACHE_DIR`` is used, if set.
 
     Returns
     -------
     info : instance of mne.io.meas_info.Info
         The MNE channel info object.
     """
-    _, config = get_file_paths(
-        subject=subject, data_type=data_type,
-        output='meg_data',
-        run_index=run_index, processing='unprocessed', hcp_path=hcp_path)
+    config = get_file_paths(
+        subject=subject, data_type=data_type, output='meg_data',
+        run_index=run_index, processing='unprocessed', hcp_path=hcp_path)[1]
 
-    meg_info = _read_bti_info(None, config)
-    return meg_info
+    with _local_files([config]) as (config,):
+        meg_info = _cached_call(partial(_read_bti_info, None), config,
+                                memory=_info_cache, cache_dir=cache_dir,
+                                kind='info')
+    return meg_info.copy()  # callers modify the info
 
 
 def read_epochs_hcp(subject, data_type, onset='TIM', run_index=0,
-                    hcp_path=op.curdir):
+                    hcp_path=op.curdir, trials=None, picks=None,
+                    cache_dir=None):
     """Read HCP processed data
 
     Parameters
@@ -225,6 +540,18 @@ def read_epochs_hcp(subject, data_type, onset='TIM', run_index=0,
         type.
     hcp_path : str
         The HCP directory, defaults to op.curdir.
+    trials : array-like of int | None
+        The trials to read. If None, all trials are read. For MATLAB v7.3
+        (HDF5) files only these trials are read from disk.
+    picks : array-like of int | None
+        The channels to read, indexing the channels stored in the
+        preprocessed file. If None, all channels are read.
+    cache_dir : str | None
+        The directory of the binary cache, see `hcp.io.build_cache_hcp`.
+        If None, the MNE config variable ``MNE_HCP_CACHE_DIR`` is used,
+        if set. When a cache directory is available, fresh cache entries
+        are used and missing or stale ones are (re)written. Missing
+        entries are not written when `trials` or `picks` are passed.
 
     Returns
     -------
@@ -232,26 +559,168 @@ def read_epochs_hcp(subject, data_type, onset='TIM', run_index=0,
         The MNE epochs. Note, these are pseudo-epochs in the case of
         onset == 'rest'.
     """
-    info = read_info_hcp(subject=subject, data_type='data_type',
-                         run_index=run_index)
+    info = read_info_hcp(subject=subject, data_type=data_type,
+                         run_index=run_index, hcp_path=hcp_path,
+                         cache_dir=cache_dir)
 
     epochs_mat_fname = get_file_paths(
         subject=subject, data_type=data_type,
         output='meg_data', run_index=run_index, processing='preprocessed',
         hcp_path=hcp_path)[0]
 
-    epochs = _read_epochs(epochs_mat_fname=epochs_mat_fname, info=info)
+    with _local_files([epochs_mat_fname]) as (epochs_mat_fname,):
+        epochs = _read_epochs(epochs_mat_fname=epochs_mat_fname, info=info,
+                              trials=trials, picks=picks, subject=subject,
+                              cache_dir=cache_dir)
 
     return epochs
 
 
-def _read_epochs(epochs_mat_fname, info):
-    """ read the epochs from matfile """
-    data = scio.loadmat(epochs_mat_fname,
-                        squeeze_me=True)['data']
+def _stack_trials(trials, dtype=np.float64):
+    """ helper to stack FieldTrip trial cells into one preallocated array
+
+    Each cell is released once it has been copied, so the loaded trials
+    and the stacked array do not coexist in full.
+    """
+    n_channels, n_times = trials[0].shape
+    data = np.empty((len(trials), n_channels, n_times), dtype=dtype)
+    for ii in range(len(trials)):
+        data[ii] = trials[ii]
+        trials[ii] = None
+    return data
+
+
+def _check_h5py():
+    """helper to import h5py for MATLAB v7.3 files"""
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError('Reading MATLAB v7.3 files requires h5py, please '
+                          'install it.')
+    return h5py
+
+
+def _is_mat_v73(fname):
+    """helper to tell MATLAB v7.3 (HDF5) files from older formats"""
+    with open(fname, 'rb') as fid:
+        fid.seek(512)  # HDF5 user block holding the MATLAB header
+        return fid.read(8) == b'\x89HDF\r\n\x1a\n'
+
+
+def _h5_to_py(fid, obj):
+    """helper to decode a MATLAB v7.3 object like loadmat(squeeze_me=True)"""
+    h5py = _check_h5py()
+    if isinstance(obj, h5py.Group):  # struct
+        fields = [k for k in obj.keys() if not k.startswith('#')]
+        out = np.empty(1, dtype=[(k, np.object_) for k in fields])
+        for field in fields:
+            out[field][0] = _h5_to_py(fid, obj[field])
+        return out.reshape(())
+    matlab_class = obj.attrs.get('MATLAB_class', b'')
+    if isinstance(matlab_class, bytes):
+        matlab_class = matlab_class.decode('ascii')
+    if obj.attrs.get('MATLAB_empty', 0):
+        return np.array([])
+    value = obj[()]
+    if matlab_class == 'cell':
+        refs = value.T.ravel()  # MATLAB is column major
+        out = np.empty(len(refs), dtype=np.object_)
+        for ii, ref in enumerate(refs):
+            out[ii] = _h5_to_py(fid, fid[ref])
+        return out if len(out) > 1 else out[0]
+    if matlab_class == 'char':
+        return ''.join(chr(c) for c in value.T.ravel())
+    value = value.T.squeeze()
+    return value if value.ndim else value.item()
+
+
+def _loadmat(fname, variable_name):
+    """helper to read one variable of MATLAB file of any version"""
+    if _is_mat_v73(fname):
+        h5py = _check_h5py()
+        with h5py.File(fname, 'r') as fid:
+            return _h5_to_py(fid, fid[variable_name])
+    return scio.loadmat(fname, squeeze_me=True,
+                        variable_names=[variable_name])[variable_name]
+
+
+def _read_epochs_data_h5(epochs_mat_fname, trials, picks):
+    """ helper to read selected trials and channels from a v7.3 matfile """
+    h5py = _check_h5py()
+    with h5py.File(epochs_mat_fname, 'r') as fid:
+        data = fid['data']
+        ch_names = _h5_to_py(fid, data['label']).tolist()
+        sfreq = _h5_to_py(fid, data['fsample'])
+        refs = data['trial'][()].T.ravel()
+        trials = (np.arange(len(refs)) if trials is None else
+                  np.atleast_1d(trials))
+        picks = (np.arange(len(ch_names)) if picks is None else
+                 np.atleast_1d(picks))
+        # h5py selections need increasing indices
+        columns, inverse = np.unique(picks, return_inverse=True)
+        n_times = fid[refs[trials[0]]].shape[0]  # stored as times x chans
+        out = np.empty((len(trials), len(picks), n_times), dtype=np.float64)
+        for ii, trial in enumerate(trials):
+            out[ii] = fid[refs[trial]][:, columns].T[inverse]
+    return out, [ch_names[pick] for pick in picks], sfreq
+
+
+def _read_epochs_data(epochs_mat_fname, trials=None, picks=None):
+    """ helper to read data, channel names and sfreq from matfile """
+    if _is_mat_v73(epochs_mat_fname):
+        return _read_epochs_data_h5(
+            epochs_mat_fname, trials=trials, picks=picks)
+    data = _loadmat(epochs_mat_fname, 'data')
     ch_names = [ch for ch in data['label'].tolist()]
-    info['sfreq'] = data['fsample'].tolist()
-    data = np.array([data['trial'].tolist()][0].tolist())
+    sfreq = data['fsample'].tolist()
+    cells = data['trial'].tolist()
+    if cells.dtype != np.object_:  # a single trial got squeezed
+        cells = np.array([None], dtype=np.object_)
+        cells[0] = data['trial'].tolist()
+    if trials is not None:
+        cells = cells[np.atleast_1d(trials)]
+    # EpochsArray keeps float64 arrays as they are, avoid another copy.
+    data = _stack_trials(cells, dtype=np.float64)
+    if picks is not None:
+        data = data[:, picks]
+        ch_names = [ch_names[pick] for pick in picks]
+    return data, ch_names, sfreq
+
+
+def _read_epochs_data_cached(epochs_mat_fname, subject, trials, picks,
+                             cache_dir):
+    """ helper to serve epochs data from the binary cache """
+    def reader():
+        data, ch_names, sfreq = _read_epochs_data(epochs_mat_fname)
+        return dict(data=data, ch_names=ch_names, sfreq=sfreq)
+
+    # filling the cache decodes the whole file, read selections lazily
+    cached = _cached_entry(reader, [epochs_mat_fname], subject=subject,
+                           kind='epochs', cache_dir=cache_dir,
+                           fill=trials is None and picks is None)
+    if cached is None:
+        return _read_epochs_data(epochs_mat_fname, trials=trials,
+                                 picks=picks)
+    data, ch_names = cached['data'], cached['ch_names']
+    if trials is not None:
+        data = data[np.atleast_1d(trials)]
+    if picks is not None:
+        data = data[:, picks]
+        ch_names = [ch_names[pick] for pick in picks]
+    return data, ch_names, cached['sfreq']
+
+
+def _read_epochs(epochs_mat_fname, info, trials=None, picks=None,
+                 subject=None, cache_dir=None):
+    """ read the epochs from matfile """
+    if get_cache_dir(cache_dir) is None:
+        data, ch_names, sfreq = _read_epochs_data(
+            epochs_mat_fname, trials=trials, picks=picks)
+    else:
+        data, ch_names, sfreq = _read_epochs_data_cached(
+            epochs_mat_fname, subject=subject, trials=trials, picks=picks,
+            cache_dir=cache_dir)
+    info['sfreq'] = sfreq
     events = np.zeros((len(data), 3), dtype=np.int)
     events[:, 0] = np.arange(len(data))
     events[:, 2] = 99
@@ -261,22 +730,28 @@ def _read_epochs(epochs_mat_fname, info):
     return EpochsArray(data=data, info=this_info, events=events, tmin=0)
 
 
-def read_trial_info_hcp(subject, data_type, run_index=0, hcp_path=op.curdir):
+def read_trial_info_hcp(subject, data_type, run_index=0, hcp_path=op.curdir,
+                        cache_dir=None):
     """ read trial info """
 
     trial_info_mat_fname = get_file_paths(
         subject=subject, data_type=data_type,
-        output='meg_data', run_index=run_index, processing='preprocessed',
+        output='trial_info', run_index=run_index, processing='preprocessed',
         hcp_path=hcp_path)[0]
 
-    trl_infos = _read_trial_info(trial_info_mat_fname=trial_info_mat_fname)
+    with _local_files([trial_info_mat_fname]) as (trial_info_mat_fname,):
+        trl_infos = _cached_entry(
+            partial(_read_trial_info,
+                    trial_info_mat_fname=trial_info_mat_fname),
+            [trial_info_mat_fname], subject=subject, kind='trial_info',
+            cache_dir=cache_dir)
     return trl_infos
 
 
 def _read_trial_info(trial_info_mat_fname):
     """ helper to read trial info """
 
-    data = scio.loadmat(trial_info_mat_fname, squeeze_me=True)['trlInfo']
+    data = _loadmat(trial_info_mat_fname, 'trlInfo')
     out = dict()
 
     for idx, lock_name in enumerate(data['lockNames'].tolist()):
@@ -299,26 +774,15 @@ def _check_sorting_runs(candidates, id_char):
 
 def _parse_annotations_segments(segment_strings):
     """Read bad segments defintions from text file"""
-    for char in '}]':  # multi line array definitions
-        segment_strings = segment_strings.replace(
-            char + ';', 'splitme'
-        )
-    split = segment_strings.split('splitme')
     out = dict()
-    for entry in split:
-        if len(entry) == 1 or entry == '\n':
-            continue
-        key, rest = entry.split(' = ')
-        val = np.array(
-            [k for k in [''.join([c for c in e if c.isdigit()])
-             for e in rest.split()] if k.isdigit()], dtype=int)
+    for key, _, val in _parse_assignments(segment_strings):
         # reindex and reshape
-        val = val.reshape(-1, 2) - 1
-        out[key.split('.')[1]] = val
+        out[key] = _to_array(val, int).reshape(-1, 2) - 1
     return out
 
 
-def read_annot_hcp(subject, data_type, run_index=0, hcp_path=op.curdir):
+def read_annot_hcp(subject, data_type, run_index=0, hcp_path=op.curdir,
+                   cache_dir=None):
     """ Read annotations for bad data and ICA.
 
     Parameters
@@ -337,6 +801,11 @@ def read_annot_hcp(subject, data_type, run_index=0, hcp_path=op.curdir):
         type.
     hcp_path : str
         The HCP directory, defaults to op.curdir.
+    cache_dir : str | None
+        The directory of the binary cache, see `hcp.io.build_cache_hcp`.
+        If None, the MNE config variable ``MNE_HCP_CACHE_DIR`` is used,
+        if set. When a cache directory is available, fresh cache entries
+        are used and missing or stale ones are (re)written.
 
     Returns
     -------
@@ -358,20 +827,30 @@ def read_annot_hcp(subject, data_type, run_index=0, hcp_path=op.curdir):
         hcp_path=hcp_path)
     ica_fname = [k for k in ica_files if k.endswith('icaclass_vs.txt')][0]
 
-    out = dict()
-    iter_fun = [
-        ('channels', _parse_annotations_bad_channels, bads_fname),
-        ('segments', _parse_annotations_segments, segments_fname),
-        ('ica', _parse_annotations_ica, ica_fname)]
+    with _local_files([bads_fname, segments_fname, ica_fname]) as fnames:
+        bads_fname, segments_fname, ica_fname = fnames
+        iter_fun = [
+            ('channels', _parse_annotations_bad_channels, bads_fname),
+            ('segments', _parse_annotations_segments, segments_fname),
+            ('ica', _parse_annotations_ica, ica_fname)]
+
+        out = _cached_entry(partial(_read_annot, iter_fun), fnames,
+                            subject=subject, kind='annot',
+                            cache_dir=cache_dir)
+    return out
 
+
+def _read_annot(iter_fun):
+    """ helper to parse the annotation files """
+    out = dict()
     for subtype, fun, fname in iter_fun:
         with open(fname, 'r') as fid:
             out[subtype] = fun(fid.read())
-
     return out
 
 
-def read_ica_hcp(subject, data_type, run_index=0, hcp_path=op.curdir):
+def read_ica_hcp(subject, data_type, run_index=0, hcp_path=op.curdir,
+                 cache_dir=None):
     """
     Parameters
     ----------
@@ -381,6 +860,11 @@ def read_ica_hcp(subject, data_type, run_index=0, hcp_path=op.curdir):
         The HCP directory
     kind : str
         the data type
+    cache_dir : str | None
+        The directory of the binary cache, see `hcp.io.build_cache_hcp`.
+        If None, the MNE config variable ``MNE_HCP_CACHE_DIR`` is used,
+        if set. When a cache directory is available, fresh cache entries
+        are used and missing or stale ones are (re)written.
 
     Returns
     -------
@@ -394,57 +878,37 @@ def read_ica_hcp(subject, data_type, run_index=0, hcp_path=op.curdir):
         hcp_path=hcp_path)
     ica_fname_mat = [k for k in ica_files if k.endswith('icaclass.mat')][0]
 
-    mat = scio.loadmat(ica_fname_mat, squeeze_me=True)['comp_class']
+    with _local_files([ica_fname_mat]) as (ica_fname_mat,):
+        mat = _cached_entry(partial(_loadmat, ica_fname_mat, 'comp_class'),
+                            [ica_fname_mat], subject=subject, kind='ica',
+                            cache_dir=cache_dir)
     return mat
 
 
 def _parse_annotations_bad_channels(bads_strings):
     """Read bad channel definitions from text file"""
-    for char in '}]':
-        bads_strings = bads_strings.replace(
-            char + ';', 'splitme'
-        )
-    split = bads_strings.split('splitme')
     out = dict()
-    for entry in split:
-        if len(entry) == 1 or entry == '\n':
-            continue
-        key, rest = entry.split(' = ')
-        val = [ch for ch in rest.split("'") if ch.isalnum()]
-        out[key.split('.')[1]] = val
+    for key, kind, val in _parse_assignments(bads_strings):
+        if kind == 'array':  # e.g., [] or ['A2' 'A42']
+            val = (_quoted_re.findall(val) if "'" in val else
+                   val.replace(',', ' ').split())
+        elif kind != 'cell':
+            val = [val] if val else []
+        out[key] = val
     return out
 
 
 def _parse_annotations_ica(ica_strings):
     """Read bad channel definitions from text file"""
-    # prepare splitting
-    for char in '}]':  # multi line array definitions
-        ica_strings = ica_strings.replace(
-            char + ';', 'splitme'
-        )
-    # scalar variables
-    match_inds = list()
-    for match in re.finditer(';', ica_strings):
-        ii = match.start()
-        if ica_strings[ii - 1].isalnum():
-            match_inds.append(ii)
-
-    ica_strings = list(ica_strings)
-    for ii in match_inds:
-        ica_strings[ii] = 'splitme'
-    ica_strings = ''.join(ica_strings)
-
-    split = ica_strings.split('splitme')
     out = dict()
-    for entry in split:
-        if len(entry) == 1 or entry == '\n':
-            continue
-        key, rest = entry.split(' = ')
-        if '[' in rest:
-            sep = ' '
+    for key, kind, val in _parse_assignments(ica_strings):
+        if kind == 'array':
+            val = [int(v) for v in val.replace(',', ' ').split()]
+        elif kind == 'cell':
+            pass
+        elif val.isdigit():
+            val = [int(val)]
         else:
-            sep = "'"
-        val = [(int(ch) if ch.isdigit() else ch) for ch in
-               rest.split(sep) if ch.isalnum()]
-        out[key.split('.')[1]] = val
+            val = [val]
+        out[key] = val
     return out
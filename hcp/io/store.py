@@ -0,0 +1,389 @@
+# Author: Denis A. Engemann <denis.engemann@gmail.com>
+# License: BSD (3-clause)
+
+import os
+import os.path as op
+import hashlib
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from mne.utils import get_config, logger
+
+from .download import get_backend
+
+try:
+    import fcntl
+except ImportError:  # Windows, no locking across processes
+    fcntl = None
+
+_schema = """
+CREATE TABLE IF NOT EXISTS keys (key TEXT PRIMARY KEY, digest TEXT);
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY, size INTEGER, atime REAL);
+"""
+
+
+@contextmanager
+def _file_lock(fname):
+    """helper to hold an exclusive lock shared by all processes"""
+    with open(fname, 'a') as fid:
+        if fcntl is not None:
+            fcntl.flock(fid, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fid, fcntl.LOCK_UN)
+
+
+class _Pin(object):
+    """A shared lock keeping a stored file from being evicted
+
+    The lock is released by `close` or once the pin is garbage collected.
+    Copies share the lock, such that objects holding a pin can be copied.
+    """
+
+    def __init__(self, fname, fid):
+        self.fname = fname
+        self._fid = fid
+
+    def close(self):
+        if self._fid is not None:
+            if fcntl is not None:
+                fcntl.flock(self._fid, fcntl.LOCK_UN)
+            self._fid.close()
+            self._fid = None
+
+    def __del__(self):
+        self.close()
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class FileStore(object):
+    """A local, content addressed cache of remote HCP files
+
+    Files are stored once per content under ``root/objects``, whatever
+    the number of keys pointing to them. When the store grows beyond
+    `quota`, the least recently used files are evicted, except for files
+    pinned by a reader, see `pin`. Files are downloaded to a temporary
+    file and moved in place, and a lock per key makes sure concurrent
+    processes download each file only once.
+
+    Parameters
+    ----------
+    root : str
+        The local directory of the store, e.g., on an SSD.
+    backend : str | instance of S3Backend | LocalBackend
+        Where to download from, see `hcp.io.get_backend`.
+    quota : int | None
+        The maximum number of bytes stored. If None, files are never
+        evicted.
+    """
+
+    def __init__(self, root, backend, quota=None):
+        if isinstance(backend, str):
+            backend = get_backend(backend)
+        self.root = root
+        self.backend = backend
+        self.quota = quota
+        for subdir in ('objects', 'locks', 'tmp'):
+            if not op.isdir(op.join(root, subdir)):
+                try:
+                    os.makedirs(op.join(root, subdir))
+                except OSError:  # created by another process meanwhile
+                    pass
+        con = self._connect()
+        try:
+            con.executescript(_schema)
+        finally:
+            con.close()
+
+    def _connect(self):
+        return sqlite3.connect(op.join(self.root, 'store.sqlite'),
+                               timeout=60.)
+
+    def _blob_fname(self, digest):
+        return op.join(self.root, 'objects', digest[:2], digest)
+
+    def _pin_fname(self, digest):
+        return op.join(self.root, 'locks', '%s.pin' % digest)
+
+    def _lookup(self, key):
+        """helper to find the stored file of a key, None if missing"""
+        con = self._connect()
+        try:
+            with con:
+                row = con.execute('SELECT digest FROM keys WHERE key = ?',
+                                  (key,)).fetchone()
+                if row is None or not op.isfile(self._blob_fname(row[0])):
+                    return None
+                con.execute('UPDATE blobs SET atime = ? WHERE digest = ?',
+                            (time.time(), row[0]))
+        finally:
+            con.close()
+        return self._blob_fname(row[0])
+
+    def _fill(self, key):
+        """helper to download a key into the store"""
+        tmp_fname = op.join(self.root, 'tmp', '%s.%d' % (
+            hashlib.sha1(key.encode('utf-8')).hexdigest(), os.getpid()))
+        sha256 = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_fname, 'wb') as fid:
+                for chunk in self.backend.iter_range(key):
+                    fid.write(chunk)
+                    sha256.update(chunk)
+                    size += len(chunk)
+        except Exception:
+            os.remove(tmp_fname)
+            raise
+        digest = sha256.hexdigest()
+        blob_fname = self._blob_fname(digest)
+        if not op.isdir(op.dirname(blob_fname)):
+            try:
+                os.makedirs(op.dirname(blob_fname))
+            except OSError:
+                pass
+        os.replace(tmp_fname, blob_fname)
+        con = self._connect()
+        try:
+            with con:
+                con.execute('INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)',
+                            (digest, size, time.time()))
+                con.execute('INSERT OR REPLACE INTO keys VALUES (?, ?)',
+                            (key, digest))
+        finally:
+            con.close()
+        logger.info('stored %s (%d bytes)' % (key, size))
+        self._evict(keep=digest)
+        return blob_fname
+
+    def _evict(self, keep):
+        """helper to drop least recently used files beyond the quota"""
+        if self.quota is None:
+            return
+        con = self._connect()
+        try:
+            with con:
+                con.execute('BEGIN IMMEDIATE')  # one process evicts at once
+                total = con.execute(
+                    'SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+                rows = con.execute(
+                    'SELECT digest, size FROM blobs WHERE digest != ? '
+                    'ORDER BY atime', (keep,)).fetchall()
+                for digest, size in rows:
+                    if total <= self.quota:
+                        break
+                    if not self._remove_unpinned(digest):
+                        logger.debug('%s is in use, not evicted' % digest)
+                        continue
+                    con.execute('DELETE FROM blobs WHERE digest = ?',
+                                (digest,))
+                    con.execute('DELETE FROM keys WHERE digest = ?',
+                                (digest,))
+                    total -= size
+                    logger.debug('evicted %s' % digest)
+        finally:
+            con.close()
+
+    def _remove_unpinned(self, digest):
+        """helper to delete a stored file unless a reader pinned it"""
+        pin_fname = self._pin_fname(digest)
+        with open(pin_fname, 'a') as fid:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(fid, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):  # pinned
+                    return False
+            for fname in (self._blob_fname(digest), pin_fname):
+                try:
+                    os.remove(fname)
+                except OSError:
+                    pass
+        return True
+
+    def fetch(self, key):
+        """Get the local path of a key, downloading it if needed
+
+        Parameters
+        ----------
+        key : str
+            The key, e.g., 'HCP_900/100307/unprocessed/MEG/...'.
+
+        Returns
+        -------
+        fname : str
+            The local file. It may be evicted once other files are
+            fetched, hence open it before fetching many more.
+        """
+        fname = self._lookup(key)
+        if fname is not None:
+            return fname
+        lock_fname = op.join(self.root, 'locks', '%s.lock' % (
+            hashlib.sha1(key.encode('utf-8')).hexdigest()))
+        with _file_lock(lock_fname):
+            # another process may have filled it while we waited
+            fname = self._lookup(key)
+            if fname is None:
+                fname = self._fill(key)
+        return fname
+
+    def pin(self, key):
+        """Get the local file of a key and keep it from being evicted
+
+        Use this instead of `fetch` when the file is opened repeatedly or
+        over a long time, e.g., by a raw object reading lazily. Pins are
+        shared locks, hence any number of processes can pin a file.
+
+        Parameters
+        ----------
+        key : str
+            The key, e.g., 'HCP_900/100307/unprocessed/MEG/...'.
+
+        Returns
+        -------
+        pin : object
+            The local file is ``pin.fname``. It is kept until
+            ``pin.close()`` is called or the pin is garbage collected.
+        """
+        while True:
+            fname = self.fetch(key)
+            pin_fname = self._pin_fname(op.basename(fname))
+            fid = open(pin_fname, 'a')
+            if fcntl is not None:
+                fcntl.flock(fid, fcntl.LOCK_SH)
+            # the file may have been evicted before the lock was taken
+            try:
+                pinned = (op.isfile(fname) and os.fstat(fid.fileno()).st_ino ==
+                          os.stat(pin_fname).st_ino)
+            except OSError:
+                pinned = False
+            if pinned:
+                return _Pin(fname, fid)
+            _Pin(fname, fid).close()
+
+    @property
+    def size(self):
+        """The number of bytes stored"""
+        con = self._connect()
+        try:
+            return con.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+        finally:
+            con.close()
+
+
+# (backend URL, root) -> store, to share stores across readers
+_stores = dict()
+
+
+def _split_url(url):
+    """helper to split a URL into the backend URL and the key"""
+    scheme, path = url.split('://', 1)
+    if scheme == 'file':
+        return 'file:///', path.lstrip('/')
+    bucket, _, key = path.partition('/')
+    return '%s://%s' % (scheme, bucket), key
+
+
+def get_store(url, store_dir=None, quota=None):
+    """Get the store serving a remote URL
+
+    Parameters
+    ----------
+    url : str
+        The URL of a remote file or of the bucket, e.g.,
+        's3://hcp-openaccess'.
+    store_dir : str | None
+        The local directory of the store. If None, the MNE config
+        variable ``MNE_HCP_STORE_DIR`` is used. If that is not set
+        either, the store last set up for the same bucket is used.
+    quota : int | None
+        The maximum number of bytes stored. If None, the MNE config
+        variable ``MNE_HCP_STORE_QUOTA`` is used, if not set either files
+        are never evicted.
+
+    Returns
+    -------
+    store : instance of FileStore
+        The store.
+    """
+    backend_url = _split_url(url)[0]
+    if store_dir is None:
+        store_dir = get_config('MNE_HCP_STORE_DIR', None)
+    if store_dir is None:
+        roots = [root for this_url, root in _stores if this_url == backend_url]
+        if roots:
+            store_dir = roots[-1]
+    if store_dir is None:
+        raise ValueError('Reading remote files requires a local store, '
+                         'please set the MNE config variable '
+                         'MNE_HCP_STORE_DIR.')
+    if quota is None:
+        quota = get_config('MNE_HCP_STORE_QUOTA', None)
+        quota = None if quota is None else int(quota)
+    key = (backend_url, op.realpath(store_dir))
+    store = _stores.get(key)
+    if store is None:
+        store = FileStore(store_dir, backend_url, quota=quota)
+        _stores[key] = store
+    elif quota is not None:
+        store.quota = quota
+    return store
+
+
+def fetch_remote(url):
+    """Get the local path of a remote file through its store
+
+    Parameters
+    ----------
+    url : str
+        The URL, e.g., 's3://hcp-openaccess/HCP_900/100307/...'.
+
+    Returns
+    -------
+    fname : str
+        The local file.
+    """
+    return get_store(url).fetch(_split_url(url)[1])
+
+
+def pin_remote(url):
+    """Get the local file of a remote file, kept until the pin is closed
+
+    Parameters
+    ----------
+    url : str
+        The URL, e.g., 's3://hcp-openaccess/HCP_900/100307/...'.
+
+    Returns
+    -------
+    pin : object
+        The local file is ``pin.fname``, see `FileStore.pin`.
+    """
+    return get_store(url).pin(_split_url(url)[1])
+
+
+@contextmanager
+def _local_files(fnames):
+    """helper to resolve the paths of `get_file_paths` for reading
+
+    Remote files are fetched through their store and pinned until the
+    block is left, local files are passed through.
+    """
+    pins = [pin_remote(fname) if '://' in fname else None
+            for fname in fnames]
+    try:
+        yield [fname if pin is None else pin.fname
+               for fname, pin in zip(fnames, pins)]
+    finally:
+        for pin in pins:
+            if pin is not None:
+                pin.close()
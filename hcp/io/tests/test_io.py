@@ -1,7 +1,10 @@
+import os
 import os.path as op
+import hashlib
+import time
 
 import numpy as np
-from nose.tools import assert_equal, assert_true
+from nose.tools import assert_equal, assert_true, assert_raises
 
 import hcp
 from mne.utils import _TempDir
@@ -35,3 +38,580 @@ def test_read_annot():
             if len(components) > 0:
                 assert_true(min(components) >= 0)
                 assert_true(max(components) <= 248)
+
+
+def test_read_raw_lazy():
+    """Test lazy raw reading matches preloaded data"""
+    raw_lazy = hcp.io.read_raw_hcp(subject='100307', data_type='rest',
+                                   hcp_path=hcp_path, preload=False)
+    assert_true(not raw_lazy.preload)
+    raw = hcp.io.read_raw_hcp(subject='100307', data_type='rest',
+                              hcp_path=hcp_path, preload=True)
+    assert_equal(raw_lazy.ch_names, raw.ch_names)
+    np.testing.assert_array_equal(raw_lazy[:, 100:200][0],
+                                  raw[:, 100:200][0])
+
+
+def test_iter_raw():
+    """Test chunked iteration over raw data"""
+    raw = hcp.io.read_raw_hcp(subject='100307', data_type='rest',
+                              hcp_path=hcp_path, preload=False)
+    n_chunk = int(round(raw.info['sfreq']))
+    n_overlap = n_chunk // 4
+    starts = list()
+    for data, start in hcp.io.iter_raw_hcp(
+            subject='100307', data_type='rest', hcp_path=hcp_path,
+            chunk_duration=1., overlap=0.25, picks=[0, 1]):
+        assert_equal(data.shape[0], 2)
+        np.testing.assert_array_equal(
+            data, raw[[0, 1], start:start + data.shape[1]][0])
+        starts.append(start)
+    assert_equal(starts[1] - starts[0], n_chunk - n_overlap)
+    assert_equal(starts[-1] + data.shape[1], raw.n_times)
+
+
+def test_read_raw_window():
+    """Test reading a window of selected channels"""
+    raw = hcp.io.read_raw_hcp(subject='100307', data_type='rest',
+                              hcp_path=hcp_path, preload=False)
+    picks = [0, 5, 10]
+    raw_win = hcp.io.read_raw_hcp(subject='100307', data_type='rest',
+                                  hcp_path=hcp_path, picks=picks,
+                                  tmin=1., tmax=2.)
+    assert_equal(raw_win.ch_names, [raw.ch_names[p] for p in picks])
+    start, stop = raw.time_as_index([1., 2.])
+    np.testing.assert_allclose(raw_win[:][0], raw[picks, start:stop + 1][0])
+
+
+def test_read_info_cache():
+    """Test memoized info reading"""
+    tmp = _TempDir()
+    info1 = hcp.io.read_info_hcp(subject='100307', data_type='rest',
+                                 hcp_path=hcp_path, cache_dir=tmp)
+    info1['sfreq'] = 1.  # modifying a returned info must not leak
+    info2 = hcp.io.read_info_hcp(subject='100307', data_type='rest',
+                                 hcp_path=hcp_path, cache_dir=tmp)
+    assert_true(info2['sfreq'] != 1.)
+    assert_equal(len(os.listdir(tmp)), 1)
+
+
+def test_build_cache():
+    """Test the binary cache of preprocessed data"""
+    tmp = _TempDir()
+    failed = hcp.io.build_cache_hcp(subject='100307', data_types=['rest'],
+                                    outputs=['ica', 'annot'],
+                                    hcp_path=hcp_path, cache_dir=tmp)
+    assert_equal(failed, [])
+    annots = hcp.io.read_annot_hcp(subject='100307', data_type='rest',
+                                   hcp_path=hcp_path)
+    annots_cached = hcp.io.read_annot_hcp(subject='100307', data_type='rest',
+                                          hcp_path=hcp_path, cache_dir=tmp)
+    assert_equal(sorted(annots['channels']),
+                 sorted(annots_cached['channels']))
+    for key, segments in annots['segments'].items():
+        np.testing.assert_array_equal(segments,
+                                      annots_cached['segments'][key])
+    ica_mat = hcp.io.read_ica_hcp(subject='100307', data_type='rest',
+                                  hcp_path=hcp_path)
+    ica_mat_cached = hcp.io.read_ica_hcp(subject='100307', data_type='rest',
+                                         hcp_path=hcp_path, cache_dir=tmp)
+    np.testing.assert_array_equal(ica_mat['unmixing'].tolist(),
+                                  ica_mat_cached['unmixing'].tolist())
+
+
+def test_build_cache_failures():
+    """Test broken files are listed while the cache build goes on"""
+    tmp = _TempDir()
+    fname = hcp.io.file_mapping.get_file_paths(
+        subject='100307', data_type='task_motor', output='trial_info',
+        run_index=0, processing='preprocessed', hcp_path=tmp)[0]
+    os.makedirs(op.dirname(fname))
+    with open(fname, 'wb') as fid:
+        fid.write(b'not a mat file')
+    failed = hcp.io.build_cache_hcp(
+        subject='100307', data_types=['task_motor'], outputs=['trial_info'],
+        hcp_path=tmp, cache_dir=op.join(tmp, 'cache'))
+    assert_equal(failed, [('task_motor', 0, 'trial_info'),
+                          ('task_motor', 1, 'trial_info')])
+
+
+def test_get_subject_manifest():
+    """Test the subject manifest agrees with get_file_paths"""
+    manifest = hcp.io.file_mapping.get_subject_manifest(
+        subject='100307', hcp_path=hcp_path)
+    fnames = [entry['fname'] for entry in manifest]
+    assert_equal(len(fnames), len(set(fnames)))
+    for run_index in range(3):
+        for fname in hcp.io.file_mapping.get_file_paths(
+                subject='100307', data_type='rest', output='ica',
+                processing='preprocessed', run_index=run_index,
+                hcp_path=hcp_path):
+            assert_true(fname in fnames)
+
+
+def test_scan_hcp_path():
+    """Test indexing the HCP directory"""
+    tmp = _TempDir()
+    this_hcp_path = op.join(tmp, 'HCP')
+    index_fname = op.join(tmp, 'index.sqlite')
+    get_files = hcp.io.file_mapping.get_file_paths
+    ica_files = dict((subject, [
+        fname for run_index in range(3) for fname in get_files(
+            subject=subject, data_type='rest', output='ica',
+            processing='preprocessed', run_index=run_index,
+            hcp_path=this_hcp_path)]) for subject in ('100307', '102816'))
+    # all ICA files for one subject, only the first run for the other
+    for fname in ica_files['100307'] + ica_files['102816'][:4]:
+        if not op.isdir(op.dirname(fname)):
+            os.makedirs(op.dirname(fname))
+        with open(fname, 'w') as fid:
+            fid.write('ica')
+    assert_true(hcp.io.file_mapping.scan_hcp_path(
+        this_hcp_path, index_fname) > 0)
+    # nothing changed, nothing to list
+    assert_equal(hcp.io.file_mapping.scan_hcp_path(
+        this_hcp_path, index_fname), 0)
+    files = hcp.io.file_mapping.query_hcp_index(
+        index_fname, subject='100307', data_type='rest', output='ica')
+    assert_equal(sorted(f['fname'] for f in files),
+                 sorted(op.realpath(f) for f in ica_files['100307']))
+    for this_file in files:
+        assert_equal(this_file['size'], 3)
+    assert_equal(len(hcp.io.file_mapping.query_hcp_index(
+        index_fname, present=False, subject='102816', data_type='rest',
+        output='ica')), len(ica_files['102816']) - 4)
+    find_subjects = hcp.io.file_mapping.find_subjects_hcp
+    assert_equal(find_subjects(
+        index_fname, [dict(data_type='rest', output='ica')]), ['100307'])
+    assert_equal(find_subjects(
+        index_fname, [dict(data_type='rest', output='ica', run_index=0)]),
+        ['100307', '102816'])
+    assert_raises(ValueError, find_subjects, index_fname, [])
+    assert_raises(ValueError, find_subjects, index_fname, [dict()])
+    assert_raises(ValueError, find_subjects, index_fname,
+                  [dict(fname='x')])
+
+    # added files are picked up
+    for fname in ica_files['102816'][4:]:
+        if not op.isdir(op.dirname(fname)):
+            os.makedirs(op.dirname(fname))
+        with open(fname, 'w') as fid:
+            fid.write('ica')
+    assert_true(hcp.io.file_mapping.scan_hcp_path(
+        this_hcp_path, index_fname) > 0)
+    assert_equal(find_subjects(
+        index_fname, [dict(data_type='rest', output='ica')]),
+        ['100307', '102816'])
+
+
+def test_download_hcp_files():
+    """Test downloading from a local stand-in for the bucket"""
+    tmp = _TempDir()
+    src, dest = op.join(tmp, 'bucket'), op.join(tmp, 'dest')
+    key = op.join('HCP_900', '100307', 'data.bin')
+    os.makedirs(op.join(src, op.dirname(key)))
+    os.makedirs(op.join(dest, op.dirname(key)))
+    data = np.random.RandomState(42).bytes(100000)
+    with open(op.join(src, key), 'wb') as fid:
+        fid.write(data)
+    # resume a partial download
+    with open(op.join(dest, key) + '.part', 'wb') as fid:
+        fid.write(data[:1234])
+    failed = hcp.io.download_hcp_files(
+        [key, 'HCP_900/missing'], backend='file://' + src, dest_dir=dest,
+        chunk_size=4096)
+    assert_equal([k for k, _ in failed], ['HCP_900/missing'])
+    with open(op.join(dest, key), 'rb') as fid:
+        assert_equal(fid.read(), data)
+    assert_true(not op.exists(op.join(dest, key) + '.part'))
+
+
+class _FakeS3Body(object):
+    def __init__(self, data):
+        self.data = data
+
+    def iter_chunks(self, chunk_size):
+        for start in range(0, len(self.data), chunk_size):
+            yield self.data[start:start + chunk_size]
+
+
+class _FakeS3Client(object):
+    """helper mimicking the boto3 calls of S3Backend, counting requests"""
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.calls = list()
+        self.heads = list()
+
+    def head_object(self, Bucket, Key):
+        self.calls.append('head')
+        self.heads.append(Key)
+        data = self.objects[Key]
+        return dict(ContentLength=len(data),
+                    ETag='"%s"' % hashlib.md5(data).hexdigest())
+
+    def get_object(self, Bucket, Key, Range):
+        self.calls.append('get')
+        start, stop = Range[len('bytes='):].split('-')
+        stop = len(self.objects[Key]) if not stop else int(stop) + 1
+        return dict(Body=_FakeS3Body(self.objects[Key][int(start):stop]))
+
+
+def test_s3_backend():
+    """Test S3 downloads issue one HEAD per key"""
+    from hcp.io.download import S3Backend
+    tmp = _TempDir()
+    key = 'HCP_900/100307/data.bin'
+    data = np.random.RandomState(42).bytes(10000)
+    client = _FakeS3Client({key: data})
+    backend = S3Backend('hcp-openaccess', client=client)
+    assert_equal(hcp.io.download_hcp_files([key], backend, tmp,
+                                           chunk_size=4096), [])
+    assert_equal(client.calls, ['head', 'get'])
+    with open(op.join(tmp, key), 'rb') as fid:
+        assert_equal(fid.read(), data)
+    assert_equal(backend.stat(key, md5=False), (len(data), None))
+    # a changed object fails the check against the ETag of the HEAD
+    os.remove(op.join(tmp, key))
+    client.get_object = lambda Bucket, Key, Range: dict(
+        Body=_FakeS3Body(data[:-1] + b'x'))
+    assert_equal(len(hcp.io.download_hcp_files([key], backend, tmp)), 1)
+    assert_true(not op.exists(op.join(tmp, key)))
+
+
+def test_file_store():
+    """Test the content addressed store of remote files"""
+    tmp = _TempDir()
+    src = op.join(tmp, 'bucket')
+    os.makedirs(op.join(src, 'HCP_900'))
+    for ii, name in enumerate(['a', 'b', 'c', 'copy_of_a']):
+        with open(op.join(src, 'HCP_900', name), 'wb') as fid:
+            fid.write(bytes(bytearray([ii % 3])) * 1000)
+    store = hcp.io.FileStore(op.join(tmp, 'store'), 'file://' + src,
+                             quota=2500)
+    fname = store.fetch('HCP_900/a')
+    with open(fname, 'rb') as fid:
+        assert_equal(fid.read(), b'\x00' * 1000)
+    assert_equal(store.fetch('HCP_900/a'), fname)
+    # same content, same file
+    assert_equal(store.fetch('HCP_900/copy_of_a'), fname)
+    assert_equal(store.size, 1000)
+    store.fetch('HCP_900/b')
+    store.fetch('HCP_900/c')  # over quota, evicts a
+    assert_equal(store.size, 2000)
+    assert_true(not op.exists(fname))
+
+    # pinned files are not evicted, even if least recently used
+    pin = store.pin('HCP_900/a')  # evicts b
+    store.fetch('HCP_900/c')
+    store.fetch('HCP_900/b')  # evicts c instead of a
+    assert_equal(store.size, 2000)
+    assert_true(op.isfile(pin.fname))
+    pin.close()
+    store.fetch('HCP_900/c')  # evicts a
+    assert_true(not op.exists(pin.fname))
+
+
+def test_remote_paths():
+    """Test readers only fetch the remote files they open"""
+    tmp = _TempDir()
+    url = 'file://' + op.join(tmp, 'bucket')
+    this_hcp_path = url + '/HCP_900'
+    fnames = hcp.io.file_mapping.get_file_paths(
+        subject='100307', data_type='rest', output='bads',
+        processing='preprocessed', hcp_path=this_hcp_path)
+    assert_true(all(fname.startswith(this_hcp_path) for fname in fnames))
+    contents = {'baddata_badsegments.txt': "badsegment.all = [1 10];\n",
+                'baddata_badchannels.txt': "badchannel.all = {'A2'};\n",
+                'icaclass_vs.txt': "IC.bad = [1 2];\n"}
+    for output in ('bads', 'ica'):
+        for fname in hcp.io.file_mapping.get_file_paths(
+                subject='100307', data_type='rest', output=output,
+                processing='preprocessed', hcp_path=tmp + '/bucket/HCP_900'):
+            if not op.isdir(op.dirname(fname)):
+                os.makedirs(op.dirname(fname))
+            with open(fname, 'w') as fid:
+                fid.write(contents.get(op.basename(fname).split('_', 3)[-1],
+                                       fname))
+    store = hcp.io.get_store(url, store_dir=op.join(tmp, 'store'))
+    annots = hcp.io.read_annot_hcp(subject='100307', data_type='rest',
+                                   hcp_path=this_hcp_path)
+    assert_equal(annots['channels'], dict(all=['A2']))
+    assert_equal(annots['ica'], dict(bad=[1, 2]))
+    # the bad segments, bad channels and ICA annotations only
+    assert_equal(len(os.listdir(op.join(tmp, 'store', 'objects'))), 3)
+    assert_equal(store.size, sum(len(content)
+                                 for content in contents.values()))
+
+
+def test_prefetch_hcp_subjects():
+    """Test staging the files of the next subjects"""
+    tmp = _TempDir()
+    src, dest = op.join(tmp, 'bucket'), op.join(tmp, 'dest')
+    subjects = ['100307', '102816', '105923']
+    for subject in subjects:
+        for key in hcp.io.file_mapping.get_s3_keys_meg(
+                subject, ['rest'], outputs=('bads', 'ica')):
+            if not op.isdir(op.join(src, op.dirname(key))):
+                os.makedirs(op.join(src, op.dirname(key)))
+            with open(op.join(src, key), 'wb') as fid:
+                fid.write(b'hcp')
+    seen = list()
+    for subject, this_hcp_path, failed in hcp.io.prefetch_hcp_subjects(
+            subjects + ['nobody'], ['rest'], backend=src, dest_dir=dest,
+            n_ahead=1, delete=True, outputs=('bads', 'ica')):
+        seen.append(subject)
+        keys = hcp.io.file_mapping.get_s3_keys_meg(
+            subject, ['rest'], outputs=('bads', 'ica'))
+        if subject == 'nobody':
+            assert_equal(len(failed), len(keys))
+            continue
+        assert_equal(failed, [])
+        for key in keys:
+            assert_true(op.isfile(op.join(dest, key)))
+        assert_equal(this_hcp_path, op.join(dest, 'HCP_900'))
+        if len(seen) > 1:  # deleted once done
+            assert_true(not op.isdir(op.join(dest, 'HCP_900', seen[-2])) or
+                        not os.listdir(op.join(dest, 'HCP_900', seen[-2],
+                                               'MEG', 'Restin', 'baddata')))
+    assert_equal(seen, subjects + ['nobody'])
+
+
+def test_prefetch_requests():
+    """Test prefetching issues one HEAD per key and stops when left"""
+    from hcp.io.download import S3Backend
+    tmp = _TempDir()
+    subjects = ['100307', '102816', '105923']
+    objects = dict()
+    for subject in subjects:
+        for key in hcp.io.file_mapping.get_s3_keys_meg(
+                subject, ['rest'], outputs=('bads', 'ica')):
+            objects[key] = b'hcp' * 1000
+    client = _FakeS3Client(objects)
+    subject_iter = hcp.io.prefetch_hcp_subjects(
+        subjects, ['rest'], backend=S3Backend('hcp-openaccess', client),
+        dest_dir=tmp, n_ahead=1, chunk_size=100, outputs=('bads', 'ica'))
+    subject, _, failed = next(subject_iter)
+    assert_equal(failed, [])
+    subject_iter.close()  # while the next subject may be downloading
+    assert_equal(len(set(client.heads)), len(client.heads))
+    calls = list(client.calls)
+    time.sleep(0.1)
+    assert_equal(client.calls, calls)  # nothing runs in the background
+
+
+def test_read_raw_remote():
+    """Test reading windows of remote raw data by byte ranges"""
+    tmp = _TempDir()
+    url = 'file://' + op.realpath(hcp_path)
+    hcp.io.get_store(url, store_dir=op.join(tmp, 'store'))
+    # the info only needs the config file
+    hcp.io.read_info_hcp(subject='100307', data_type='rest', hcp_path=url)
+    assert_true(not op.isdir(op.join(tmp, 'store', 'headers')))
+    raw = hcp.io.read_raw_hcp(subject='100307', data_type='rest',
+                              hcp_path=hcp_path, tmin=1., tmax=3.,
+                              picks=[0, 10])
+    raw_remote = hcp.io.read_raw_hcp(subject='100307', data_type='rest',
+                                     hcp_path=url, tmin=1., tmax=3.,
+                                     picks=[0, 10])
+    assert_equal(raw_remote.first_samp, raw.first_samp)
+    np.testing.assert_array_equal(raw_remote._data, raw._data)
+    # the samples were not stored locally
+    pdf = hcp.io.file_mapping.get_file_paths(
+        subject='100307', data_type='rest', output='meg_data',
+        processing='unprocessed', hcp_path=hcp_path)[0]
+    assert_true(hcp.io.get_store(url).size < os.stat(pdf).st_size)
+
+
+def _write_mat_v73(fname, ch_names, sfreq, trials):
+    """helper to write a minimal FieldTrip struct as MATLAB v7.3 file"""
+    import h5py
+    with h5py.File(fname, 'w', userblock_size=512) as fid:
+        refs = fid.create_group('#refs#')
+        data = fid.create_group('data')
+
+        def add_ref(name, value, matlab_class):
+            dset = refs.create_dataset(name, data=value)
+            dset.attrs['MATLAB_class'] = np.bytes_(matlab_class)
+            return dset.ref
+
+        label = [add_ref('l%d' % ii, np.array([[ord(c)] for c in ch],
+                                              dtype=np.uint16), 'char')
+                 for ii, ch in enumerate(ch_names)]
+        dset = data.create_dataset('label', data=np.array([label]),
+                                   dtype=h5py.ref_dtype)
+        dset.attrs['MATLAB_class'] = np.bytes_('cell')
+        dset = data.create_dataset('fsample', data=[[sfreq]])
+        dset.attrs['MATLAB_class'] = np.bytes_('double')
+        # MATLAB stores column major, channels x times as times x channels
+        trial = [add_ref('t%d' % ii, this_trial.T, 'double')
+                 for ii, this_trial in enumerate(trials)]
+        dset = data.create_dataset('trial', data=np.array([trial]),
+                                   dtype=h5py.ref_dtype)
+        dset.attrs['MATLAB_class'] = np.bytes_('cell')
+    with open(fname, 'r+b') as fid:
+        fid.write(b'MATLAB 7.3 MAT-file'.ljust(128))
+
+
+def test_read_epochs_data_v73():
+    """Test selecting trials and channels of MATLAB v7.3 files"""
+    from hcp.io.read import _is_mat_v73, _read_epochs_data
+    tmp = _TempDir()
+    rng = np.random.RandomState(0)
+    trials = rng.randn(4, 3, 20)
+    ch_names = ['A1', 'A22', 'A248']
+    fname = op.join(tmp, 'epochs.mat')
+    _write_mat_v73(fname, ch_names, 508.63, trials)
+    assert_true(_is_mat_v73(fname))
+    data, names, sfreq = _read_epochs_data(fname)
+    np.testing.assert_array_equal(data, trials)
+    assert_equal(names, ch_names)
+    assert_equal(sfreq, 508.63)
+    data, names, _ = _read_epochs_data(fname, trials=[3, 1], picks=[2, 0])
+    np.testing.assert_array_equal(data, trials[[3, 1]][:, [2, 0]])
+    assert_equal(names, ['A248', 'A1'])
+    data, _, _ = _read_epochs_data(fname, trials=2)
+    np.testing.assert_array_equal(data, trials[[2]])
+
+
+def test_read_epochs_data_single_trial():
+    """Test reading a file holding one trial"""
+    import scipy.io as scio
+    from hcp.io.read import _read_epochs_data
+    tmp = _TempDir()
+    trial = np.random.RandomState(0).randn(3, 20)
+    cells = np.empty((1, 1), dtype=np.object_)
+    cells[0, 0] = trial
+    fname = op.join(tmp, 'epochs.mat')
+    scio.savemat(fname, dict(data=dict(
+        trial=cells, label=np.array(['A1', 'A2', 'A3'], dtype=np.object_),
+        fsample=508.63)))
+    for trials in (None, [0], 0):
+        data, names, _ = _read_epochs_data(fname, trials=trials, picks=[1])
+        np.testing.assert_array_equal(data, trial[np.newaxis, [1]])
+        assert_equal(names, ['A2'])
+
+
+def test_cached_entry():
+    """Test cache entries are only written for full reads"""
+    from hcp.io.read import _read_epochs_data_cached
+    tmp = _TempDir()
+    trials = np.random.RandomState(0).randn(4, 3, 20)
+    fname = op.join(tmp, 'epochs.mat')
+    _write_mat_v73(fname, ['A1', 'A2', 'A3'], 508.63, trials)
+    cache_dir = op.join(tmp, 'cache')
+    data, _, _ = _read_epochs_data_cached(fname, '100307', trials=[1],
+                                          picks=[0], cache_dir=cache_dir)
+    np.testing.assert_array_equal(data, trials[[1]][:, [0]])
+    assert_true(not op.isdir(cache_dir))  # a selection is read lazily
+    _read_epochs_data_cached(fname, '100307', trials=None, picks=None,
+                             cache_dir=cache_dir)
+    assert_equal(os.listdir(op.join(cache_dir, '100307')),
+                 ['epochs.mat-epochs'])
+    data, names, _ = _read_epochs_data_cached(
+        fname, '100307', trials=[3, 0], picks=[2], cache_dir=cache_dir)
+    np.testing.assert_array_equal(data, trials[[3, 0]][:, [2]])
+    assert_equal(names, ['A3'])
+
+    # failing to write an entry does not fail the read
+    cache_dir = op.join(tmp, 'broken')
+    os.makedirs(cache_dir)
+    open(op.join(cache_dir, '100307'), 'w').close()
+    data, _, _ = _read_epochs_data_cached(fname, '100307', trials=None,
+                                          picks=None, cache_dir=cache_dir)
+    np.testing.assert_array_equal(data, trials)
+    assert_equal(os.listdir(cache_dir), ['100307'])
+
+
+def _read_or_fail(subject, data_type, run_index, **kwargs):
+    """helper for the batch tests, importable by worker processes"""
+    if subject == 'bad':
+        raise IOError('no data for %s' % subject)
+    return subject, data_type, run_index
+
+
+def test_iter_hcp_batch():
+    """Test ordering and error capture of the batch readers"""
+    subjects = ['100307', 'bad', '102816']
+    run_indices = [0, 1]
+    expected = [(subject, run_index) for subject in subjects
+                for run_index in run_indices]
+    for n_jobs in (1, 2):
+        for ordered in (True, False):
+            results = list(hcp.io.iter_hcp_batch(
+                _read_or_fail, subjects, 'rest', run_indices=run_indices,
+                n_jobs=n_jobs, ordered=ordered, max_in_flight=2))
+            items = [(subject, run_index)
+                     for subject, run_index, _, _ in results]
+            if ordered:
+                assert_equal(items, expected)
+            else:
+                assert_equal(sorted(items), sorted(expected))
+            for subject, run_index, out, error in results:
+                if subject == 'bad':
+                    assert_true(out is None)
+                    assert_true(isinstance(error, IOError))
+                else:
+                    assert_equal(out, (subject, 'rest', run_index))
+                    assert_true(error is None)
+    assert_raises(ValueError, list, hcp.io.iter_hcp_batch(
+        _read_or_fail, subjects, 'rest', n_jobs=0))
+
+
+def test_parse_annotations():
+    """Test parsing the HCP annotation files"""
+    from hcp.io.read import (_parse_annotations_bad_channels,
+                             _parse_annotations_segments,
+                             _parse_annotations_ica)
+    channels = _parse_annotations_bad_channels(
+        "badchannel.all = {'A2' 'A42'};\n"
+        "badchannel.ica = [];\n"
+        "badchannel.manual = ['A248'];\n"
+        "badchannel.neigh_corr = 'A7';\n"
+        "badchannel.neigh_stdratio = {};\n")
+    assert_equal(channels, dict(all=['A2', 'A42'], ica=[], manual=['A248'],
+                                neigh_corr=['A7'], neigh_stdratio=[]))
+
+    segments = _parse_annotations_segments(
+        "badsegment.all = [1 10\n  21 30\n];\n"
+        "badsegment.manual = [];\n")
+    np.testing.assert_array_equal(segments['all'], [[0, 9], [20, 29]])
+    assert_equal(segments['manual'].shape, (0, 2))
+
+    ica = _parse_annotations_ica(
+        "IC.bad = [1 2 3];\n"
+        "IC.good = [];\n"
+        "IC.physio = [4,5];\n"
+        "IC.total_ic_number = 23;\n"
+        "IC.flag = {'brain' 'ecg'};\n")
+    assert_equal(ica, dict(bad=[1, 2, 3], good=[], physio=[4, 5],
+                           total_ic_number=[23], flag=['brain', 'ecg']))
+
+
+def test_fetch_bti_header():
+    """Test mimicking a remote pdf file by its header"""
+    from hcp.io.read import _fetch_bti_header
+    tmp = _TempDir()
+    rng = np.random.RandomState(0)
+    header_position = 1008
+    header = rng.bytes(301) + np.array([header_position], '>u8').tobytes()
+    os.makedirs(op.join(tmp, 'bucket'))
+    with open(op.join(tmp, 'bucket', 'c,rfDC'), 'wb') as fid:
+        fid.write(rng.bytes(1003) + b'\0' * 5 + header)
+    store = hcp.io.FileStore(op.join(tmp, 'store'),
+                             'file://' + op.join(tmp, 'bucket'))
+    for _ in range(2):  # downloaded, then read from the store
+        fid = _fetch_bti_header(store, 'c,rfDC')
+        fid.seek(-8, 2)
+        assert_equal(fid.tell(), header_position + len(header) - 8)
+        fid.seek(header_position, 0)
+        assert_equal(fid.read(), header)
+    headers = os.listdir(op.join(tmp, 'store', 'headers'))
+    assert_equal(len(headers), 1)
+    # only the header is stored, a changed file is fetched again
+    assert_equal(os.stat(op.join(tmp, 'store', 'headers',
+                                 headers[0])).st_size, len(header))
+    with open(op.join(tmp, 'bucket', 'c,rfDC'), 'ab') as fid:
+        fid.write(b'\0' * 8)
+    _fetch_bti_header(store, 'c,rfDC')
+    assert_equal(len(os.listdir(op.join(tmp, 'store', 'headers'))), 2)
@@ -1,35 +1,101 @@
 # Author: Denis A. Engemann <denis.engemann@gmail.com>
 # License: BSD (3-clause)
 
+import os.path as op
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-from mne.io import set_bipolar_reference
-from mne.io.bti.bti import (
-    _convert_coil_trans, _coil_trans_to_loc, _get_bti_dev_t,
-    _loc_to_coil_trans)
-from mne.transforms import Transform
+from mne.io.meas_info import Info
+from mne.io.bti.bti import _get_bti_dev_t
+from mne.transforms import Transform, combine_transforms, invert_transform
+from mne.utils import logger
+
+from .io import read_ica_hcp, read_annot_hcp
+from .io.cache import _LRUCache, _cached_call
+from .io.file_mapping import get_file_paths
+from .io.store import _local_files
+
+
+_eog_ecg_types = (('ECG', 'ecg'), ('VEOG', 'eog'), ('HEOG', 'eog'))
+
+
+def _get_eog_ecg_picks(ch_names):
+    """helper to find the anodes and cathodes of the ECG and EOG"""
+    ch_names = list(ch_names)
+    anodes, cathodes = list(), list()
+    for kind, _ in _eog_ecg_types:
+        for ch_name, picks in ((kind + '-', anodes), (kind + '+', cathodes)):
+            if ch_name not in ch_names:
+                raise ValueError('Channel %s is missing, cannot derive %s.'
+                                 % (ch_name, kind))
+            picks.append(ch_names.index(ch_name))
+    return anodes, cathodes
 
 
 def set_eog_ecg_channels(raw):
     """Set the HCP ECG and EOG channels
 
-    Operates in place.
+    Operates in place. The three bipolar channels are computed at once
+    and take the places of their anodes ('ECG-', 'VEOG-', 'HEOG-'), the
+    cathodes are dropped. For data that are not loaded, see
+    `compute_eog_ecg_hcp`.
 
     Parameters
     ----------
     raw : instance of Raw
         the hcp raw data.
     """
-    for kind in ['ECG', 'VEOG', 'HEOG']:
-        set_bipolar_reference(
-            raw, anode=kind + '-', cathode=kind + '+', ch_name=kind,
-            copy=False)
-    raw.set_channel_types({'ECG': 'ecg', 'VEOG': 'eog', 'HEOG': 'eog'})
+    if not raw.preload:
+        raise RuntimeError('The raw data must be preloaded, use '
+                           'compute_eog_ecg_hcp for data that are not.')
+    anodes, cathodes = _get_eog_ecg_picks(raw.ch_names)
+    raw._data[anodes] -= raw._data[cathodes]
+    raw.rename_channels(dict(
+        (raw.ch_names[anode], kind)
+        for anode, (kind, _) in zip(anodes, _eog_ecg_types)))
+    raw.drop_channels([raw.ch_names[cathode] for cathode in cathodes])
+    raw.set_channel_types(dict(_eog_ecg_types))
+
+
+def compute_eog_ecg_hcp(inst, ch_names=None):
+    """Compute the HCP ECG and EOG bipolar channels
 
+    Parameters
+    ----------
+    inst : instance of Raw | array, shape (n_channels, n_times)
+        The hcp raw data, which do not have to be loaded as only the six
+        electrode channels are read, or a block of data, e.g., from
+        `hcp.io.iter_raw_hcp`.
+    ch_names : list of str | None
+        The channel names of the data if `inst` is an array.
 
-def apply_ica_hcp(raw, ica_mat, exclude):
+    Returns
+    -------
+    data : array, shape (3, n_times)
+        The bipolar channels.
+    ch_names : list of str
+        Their names, i.e., ['ECG', 'VEOG', 'HEOG'].
+    """
+    if isinstance(inst, np.ndarray):
+        if ch_names is None:
+            raise ValueError('`ch_names` must be given for array data.')
+        anodes, cathodes = _get_eog_ecg_picks(ch_names)
+        data = inst[anodes] - inst[cathodes]
+    else:
+        anodes, cathodes = _get_eog_ecg_picks(inst.ch_names)
+        data, _ = inst[anodes + cathodes, :]
+        data = data[:3] - data[3:]
+    return data, [kind for kind, _ in _eog_ecg_types]
+
+
+def apply_ica_hcp(raw, ica_mat, exclude, n_jobs=1, block_size=10000):
     """ Apply the HCP ICA.
 
-    Operates in place.
+    Operates in place. The excluded components are removed as a rank-k
+    update of the data, ``X -= mixing[:, exclude] (unmixing[exclude] X)``,
+    block by block, without building the full projection matrix or
+    copying the data. To clean several data sets with the same ICA, see
+    `make_ica_projector_hcp`.
 
     Parameters
     ----------
@@ -39,19 +105,274 @@ def apply_ica_hcp(raw, ica_mat, exclude):
         The hcp ICA solution
     exclude : array-like
         the components to be excluded.
+    n_jobs : int
+        The number of threads processing the blocks in parallel.
+        Defaults to 1. Each thread calls BLAS, which is usually
+        multithreaded already, hence use n_jobs > 1 only with a single
+        threaded BLAS, e.g., ``OMP_NUM_THREADS=1``, else the cores are
+        oversubscribed.
+    block_size : int
+        The number of samples processed at once. Defaults to 10000.
     """
     assert ica_mat['topolabel'].tolist().tolist() == raw.ch_names[:]
 
-    unmixing_matrix = np.array(ica_mat['unmixing'].tolist())
+    projector = ICAProjector.from_ica_mat(ica_mat, exclude)
+    projector.apply(raw, n_jobs=n_jobs, block_size=block_size)
+
+
+class ICAProjector(object):
+    """ Precomputed removal of HCP ICA components
 
-    n_components, n_channels = unmixing_matrix.shape
-    mixing = np.array(ica_mat['topo'].tolist())
+    Holds only the mixing and unmixing vectors of the excluded components,
+    hence it is small enough to be kept in memory and pickled.
+
+    Parameters
+    ----------
+    ch_names : list of str
+        The channels of the ICA solution.
+    mixing : array, shape (n_channels, n_excluded)
+        The mixing vectors of the excluded components.
+    unmixing : array, shape (n_excluded, n_channels)
+        The unmixing vectors of the excluded components.
+    exclude : array of int
+        The excluded components.
+    """
+
+    def __init__(self, ch_names, mixing, unmixing, exclude):
+        self.ch_names = list(ch_names)
+        self.mixing = mixing
+        self.unmixing = unmixing
+        self.exclude = exclude
+
+    @classmethod
+    def from_ica_mat(cls, ica_mat, exclude):
+        """ Make the projector from an HCP ICA solution
+
+        Parameters
+        ----------
+        ica_mat : numpy structured array
+            The hcp ICA solution, see `hcp.io.read_ica_hcp`.
+        exclude : array-like
+            the components to be excluded.
+
+        Returns
+        -------
+        projector : instance of ICAProjector
+            The projector.
+        """
+        exclude = np.atleast_1d(np.asarray(exclude, dtype=int))
+        unmixing = np.array(ica_mat['unmixing'].tolist())
+        mixing = np.array(ica_mat['topo'].tolist())
+        return cls(ch_names=ica_mat['topolabel'].tolist().tolist(),
+                   mixing=mixing[:, exclude], unmixing=unmixing[exclude],
+                   exclude=exclude)
+
+    def __repr__(self):
+        return '<ICAProjector | %d channels, excluding %d components>' % (
+            len(self.ch_names), len(self.exclude))
+
+    def apply(self, inst, n_jobs=1, block_size=10000):
+        """ Remove the excluded components in place
+
+        Parameters
+        ----------
+        inst : instance of Raw | Epochs | Evoked
+            The data, which must be loaded and contain all channels of the
+            ICA solution. Other channels are left untouched.
+        n_jobs : int
+            The number of threads processing blocks in parallel. Defaults
+            to 1, see `apply_ica_hcp` about combining it with BLAS
+            threads.
+        block_size : int
+            The number of samples processed at once. Defaults to 10000.
+
+        Returns
+        -------
+        inst : instance of Raw | Epochs | Evoked
+            The cleaned data.
+        """
+        missing = [ch for ch in self.ch_names if ch not in inst.ch_names]
+        if missing:
+            raise ValueError('The data lack channels of the ICA solution: '
+                             '%s' % ', '.join(missing))
+        picks = [inst.ch_names.index(ch) for ch in self.ch_names]
+        data = inst.data if hasattr(inst, 'nave') else inst._data  # Evoked
+        datasets = data if data.ndim == 3 else [data]  # Epochs
+        for this_data in datasets:
+            if picks == list(range(len(this_data))):
+                sub = this_data
+            else:
+                sub = this_data[picks]
+            _apply_ica_exclusion(sub, self.mixing, self.unmixing,
+                                 n_jobs=n_jobs, block_size=block_size)
+            if sub is not this_data:
+                this_data[picks] = sub
+        return inst
+
+
+_ica_projector_cache = _LRUCache(max_size=64)
+
+
+def make_ica_projector_hcp(subject, data_type, run_index=0,
+                           exclude='ecg_eog_ic', hcp_path=op.curdir,
+                           cache_dir=None):
+    """ Make a reusable projector removing HCP ICA components
+
+    Projectors are memoized in memory, and on disk if a cache directory
+    is available, keyed on the ICA file and the excluded components.
+    Repeated calls therefore skip reading the ICA solution.
+
+    Parameters
+    ----------
+    subject : str
+        The subject
+    data_type : str
+        The kind of data. The following options are supported:
+        'rest'
+        'task_motor'
+        'task_story_math'
+        'task_working_memory'
+    run_index : int
+        The run index. For the first run, use 0, for the second, use 1.
+    exclude : str | array-like
+        The components to be excluded. If str, the key of the ICA
+        annotations listing the components, see `hcp.io.read_annot_hcp`.
+        Their 1-based MATLAB indices are converted. Defaults to
+        'ecg_eog_ic'.
+    hcp_path : str
+        The HCP directory, defaults to op.curdir.
+    cache_dir : str | None
+        A directory in which projectors are additionally pickled. If
+        None, the MNE config variable ``MNE_HCP_CACHE_DIR`` is used, if
+        set.
+
+    Returns
+    -------
+    projector : instance of ICAProjector
+        The projector, see `ICAProjector.apply`.
+    """
+    if isinstance(exclude, str):
+        annots = read_annot_hcp(subject=subject, data_type=data_type,
+                                run_index=run_index, hcp_path=hcp_path,
+                                cache_dir=cache_dir)
+        exclude = np.array(annots['ica'][exclude], dtype=int) - 1
+    exclude = np.atleast_1d(np.asarray(exclude, dtype=int))
 
-    proj_mat = (np.eye(n_channels) - np.dot(
-        mixing[:, exclude], unmixing_matrix[exclude]))
-    raw._data *= 1e15
-    raw._data[:] = np.dot(proj_mat, raw._data)
-    raw._data /= 1e15
+    ica_files = get_file_paths(
+        subject=subject, data_type=data_type,
+        output='ica', run_index=run_index, processing='preprocessed',
+        hcp_path=hcp_path)
+    ica_fname_mat = [k for k in ica_files if k.endswith('icaclass.mat')][0]
+
+    def _make_projector(fname):
+        ica_mat = read_ica_hcp(subject=subject, data_type=data_type,
+                               run_index=run_index, hcp_path=hcp_path,
+                               cache_dir=cache_dir)
+        return ICAProjector.from_ica_mat(ica_mat, exclude)
+
+    with _local_files([ica_fname_mat]) as (ica_fname_mat,):
+        return _cached_call(_make_projector, ica_fname_mat,
+                            memory=_ica_projector_cache, cache_dir=cache_dir,
+                            kind='ica-projector', extra_key=tuple(exclude))
+
+
+def apply_ica_hcp_to_file(raw, ica_mat, exclude, fname,
+                          chunk_duration=10., dtype=np.float64, n_jobs=1,
+                          overwrite=False):
+    """ Apply the HCP ICA chunk by chunk and write the result to disk
+
+    Unlike `apply_ica_hcp`, the raw data do not have to be loaded, the
+    memory used only depends on `chunk_duration`. The cleaned channels of
+    the ICA solution are written to an HDF5 file with the datasets
+
+    'data' : array, shape (n_channels, n_times)
+        The cleaned data.
+    'ch_names' : array of bytes, shape (n_channels,)
+        The channel names.
+
+    and the attributes 'sfreq' and 'first_samp'. Reading it, e.g., with
+    ``mne.io.RawArray(fid['data'][()], pick_info(raw.info, picks))``,
+    yields the same data as `apply_ica_hcp`.
+
+    Parameters
+    ----------
+    raw : instance of Raw
+        the hcp raw data, e.g., from ``read_raw_hcp(..., preload=False)``.
+        It must contain all channels of the ICA solution.
+    ica_mat : numpy structured array
+        The hcp ICA solution
+    exclude : array-like
+        the components to be excluded.
+    fname : str
+        The HDF5 output file.
+    chunk_duration : float
+        The duration in seconds of the chunks read, cleaned and written at
+        once. Defaults to 10.
+    dtype : numpy dtype
+        The dtype of the output. Defaults to np.float64.
+    n_jobs : int
+        The number of threads cleaning each chunk. Defaults to 1, see
+        `apply_ica_hcp` about combining it with BLAS threads.
+    overwrite : bool
+        If True, an existing file will be overwritten. Defaults to False.
+
+    Returns
+    -------
+    picks : array of int
+        The indices of the written channels in ``raw.ch_names``.
+    """
+    from .io.read import _check_h5py
+    h5py = _check_h5py()
+    if op.exists(fname) and not overwrite:
+        raise IOError('File %s exists, use overwrite=True to replace it.' %
+                      fname)
+    ch_names = ica_mat['topolabel'].tolist().tolist()
+    missing = [ch for ch in ch_names if ch not in raw.ch_names]
+    if missing:
+        raise ValueError('The raw data lack channels of the ICA solution: '
+                         '%s' % ', '.join(missing))
+    picks = np.array([raw.ch_names.index(ch) for ch in ch_names])
+    projector = ICAProjector.from_ica_mat(ica_mat, exclude)
+
+    n_times = raw.n_times
+    n_chunk = max(min(int(round(chunk_duration * raw.info['sfreq'])),
+                      n_times), 1)
+    with h5py.File(fname, 'w') as fid:
+        fid.create_dataset('ch_names', data=np.array(ch_names, dtype='S'))
+        dset = fid.create_dataset('data', shape=(len(picks), n_times),
+                                  dtype=dtype, chunks=(len(picks), n_chunk))
+        fid.attrs['sfreq'] = raw.info['sfreq']
+        fid.attrs['first_samp'] = raw.first_samp
+        for start in range(0, n_times, n_chunk):
+            stop = min(start + n_chunk, n_times)
+            data, _ = raw[picks, start:stop]
+            _apply_ica_exclusion(data, projector.mixing, projector.unmixing,
+                                 n_jobs=n_jobs)
+            dset[:, start:stop] = data
+    return picks
+
+
+def _apply_ica_exclusion(data, mixing, unmixing, n_jobs=1,
+                         block_size=10000):
+    """helper to remove ICA components from data in place, block-wise
+
+    `mixing` and `unmixing` only hold the excluded components.
+    """
+    if unmixing.shape[0] == 0:
+        return data
+
+    def _apply_block(start):
+        block = data[:, start:start + block_size]
+        block -= np.dot(mixing, np.dot(unmixing, block))
+
+    starts = range(0, data.shape[1], block_size)
+    if n_jobs == 1:
+        for start in starts:
+            _apply_block(start)
+    else:  # BLAS releases the GIL, threads share the data
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(_apply_block, starts))
+    return data
 
 
 def transform_sensors_to_mne(inst):
@@ -60,14 +381,49 @@ def transform_sensors_to_mne(inst):
     For several reasons we do not use the MNE coordinates for the inverse
     modeling. This however won't always play nicely with visualization.
 
+    Operates in place. All channels are converted at once.
+
+    Parameters
+    ----------
+    inst : instance of Raw | Epochs | Evoked | Info
+        The data or their measurement info.
+
+    Returns
+    -------
+    inst : instance of Raw | Epochs | Evoked | Info
+        The data or info with transformed sensor locations.
     """
+    info = inst if isinstance(inst, Info) else inst.info
     bti_dev_t = Transform('ctf_meg', 'meg', _get_bti_dev_t())
-    dev_ctf_t = inst.info['dev_ctf_t']
-    for ch in inst.info['chs']:
-        loc = ch['loc'][:]
-        if loc is not None:
-            print('converting %s' % ch['ch_name'])
-            t = _loc_to_coil_trans(loc)
-            t = _convert_coil_trans(t, dev_ctf_t, bti_dev_t)
-            loc = _coil_trans_to_loc(t)
-            ch['loc'] = loc
+    dev_ctf_t = info['dev_ctf_t']
+    # the same transform as in mne.io.bti.bti._convert_coil_trans
+    trans = combine_transforms(invert_transform(dev_ctf_t), bti_dev_t,
+                               'ctf_head', 'meg')['trans']
+    locs = np.array([ch['loc'] for ch in info['chs']], dtype=np.float64)
+    logger.debug('converting %d channels' % len(locs))
+    coil_trans = _locs_to_coil_trans(locs)
+    coil_trans = np.einsum('ij,njk->nik', trans, coil_trans)
+    for ch, loc in zip(info['chs'], _coil_trans_to_locs(coil_trans)):
+        ch['loc'] = loc
+    return inst
+
+
+def _locs_to_coil_trans(locs):
+    """helper to convert (n, 12) locs to (n, 4, 4) coil transforms
+
+    Vectorized version of mne.io.bti.bti._loc_to_coil_trans.
+    """
+    coil_trans = np.zeros((len(locs), 4, 4))
+    coil_trans[:, :3] = locs.reshape(-1, 4, 3).transpose(0, 2, 1)[
+        :, :, [1, 2, 3, 0]]
+    coil_trans[:, 3, 3] = 1.
+    return coil_trans
+
+
+def _coil_trans_to_locs(coil_trans):
+    """helper to convert (n, 4, 4) coil transforms to (n, 12) locs
+
+    Vectorized version of mne.io.bti.bti._coil_trans_to_loc.
+    """
+    locs = np.roll(coil_trans.transpose(0, 2, 1)[:, :, :3], 1, axis=1)
+    return locs.reshape(len(coil_trans), 12)
@@ -0,0 +1,29 @@
+import numpy as np
+from nose.tools import assert_true
+
+from hcp.preprocessing import _apply_ica_exclusion
+
+
+def test_apply_ica_exclusion():
+    """Test the blocked ICA exclusion matches the dense projection"""
+    rng = np.random.RandomState(42)
+    n_channels, n_components, n_times = 20, 12, 2503
+    mixing = rng.randn(n_channels, n_components)
+    unmixing = np.linalg.pinv(mixing)
+    data = rng.randn(n_channels, n_times) * 1e-12
+    exclude = np.array([0, 3, 7])
+    expected = np.dot(np.eye(n_channels) -
+                      np.dot(mixing[:, exclude], unmixing[exclude]), data)
+    for n_jobs in (1, 3):
+        for block_size in (100, 1000, 10000):
+            this_data = data.copy()
+            out = _apply_ica_exclusion(this_data, mixing[:, exclude],
+                                       unmixing[exclude], n_jobs=n_jobs,
+                                       block_size=block_size)
+            assert_true(out is this_data)  # in place
+            np.testing.assert_allclose(this_data, expected, rtol=1e-10,
+                                       atol=1e-25)
+    # nothing to exclude
+    this_data = data.copy()
+    _apply_ica_exclusion(this_data, mixing[:, []], unmixing[[]], n_jobs=2)
+    np.testing.assert_array_equal(this_data, data)
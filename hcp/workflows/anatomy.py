@@ -1,6 +1,8 @@
 import os
 import os.path as op
+import json
 import re
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 from scipy import linalg
@@ -9,14 +11,60 @@ from mne import write_trans, write_surface
 from mne.transforms import Transform, apply_trans
 from mne.utils import logger
 
-from ..io.file_mapping import get_file_paths
+from ..io.file_mapping import get_file_paths, find_subjects_hcp
 from ..io.read import _read_trans_hcp
 from ..io.read import _get_head_model
+from ..io.cache import _get_file_key
+from ..io.batch import _get_n_jobs
+
+# records the inputs each output was made from, per subject
+_state_fname = '.mne-hcp-anatomy.json'
+
+
+def _read_state(fname):
+    """helper to read the inputs outputs were made from"""
+    if not op.isfile(fname):
+        return dict()
+    with open(fname, 'r') as fid:
+        return json.load(fid)
+
+
+def _write_state(fname, state):
+    """helper to write the state such that it never appears half written"""
+    tmp_fname = '%s.%d.tmp' % (fname, os.getpid())
+    with open(tmp_fname, 'w') as fid:
+        json.dump(state, fid)
+    os.replace(tmp_fname, fname)
+
+
+def _get_inputs_key(inputs):
+    """helper to identify the state of input files"""
+    return [list(_get_file_key(fname)) for fname in inputs]
+
+
+def _is_up_to_date(state, output, inputs):
+    """helper to check an output exists and its inputs did not change"""
+    return (op.exists(output) and
+            state.get(output) == _get_inputs_key(inputs))
+
+
+def _link_files(sources, subject, this_anatomy_path):
+    """helper to symlink freesurfer files, skipping existing links"""
+    existing = dict()  # directory -> names, each directory is listed once
+    for source in sources:
+        match = [match for match in re.finditer(subject, source)][-1]
+        split_path = source[:match.span()[1] + 1]
+        target = op.join(this_anatomy_path, source.split(split_path)[-1])
+        target_dir, name = op.split(target)
+        if target_dir not in existing:
+            existing[target_dir] = set(os.listdir(target_dir))
+        if name not in existing[target_dir]:
+            os.symlink(source, target)
 
 
 def make_mne_anatomy(subject, anatomy_path, recordings_path=None,
                      hcp_path=op.curdir, mode='minimal', outputs=(
-                         'label', 'mri', 'surf')):
+                         'label', 'mri', 'surf'), force=True):
     """Extract relevant anatomy and create MNE friendly directory layout
 
     The function will create the following outputs by default:
@@ -36,6 +84,9 @@ def make_mne_anatomy(subject, anatomy_path, recordings_path=None,
         The subject name.
     anatomy_path : str
         The path corresponding to MNE/freesurfer SUBJECTS_DIR (to be created)
+    recordings_path : str | None
+        The path to which the coregistration is written. If None,
+        `anatomy_path` is used.
     hcp_path : str
         The path where the HCP files can be found.
     mode : {'minimal', 'full'}
@@ -46,6 +97,10 @@ def make_mne_anatomy(subject, anatomy_path, recordings_path=None,
         The outputs of the freesrufer pipeline shipped by HCP. Defaults to
         ('mri', 'surf'), the minimum needed to extract MNE-friendly anatomy
         files and data.
+    force : bool
+        If True (default), the head model and the coregistration are
+        written again. If False, they are only written if their HCP inputs
+        changed (mtime or size) since they were last written.
     """
     if mode not in ('full', 'minimal'):
         raise ValueError('`mode` must either be "minimal" or "full"')
@@ -55,6 +110,8 @@ def make_mne_anatomy(subject, anatomy_path, recordings_path=None,
         anatomy_path = op.realpath(anatomy_path)
 
     this_anatomy_path = op.join(anatomy_path, subject)
+    if recordings_path is None:
+        recordings_path = anatomy_path
     if not op.isabs(recordings_path):
         recordings_path = op.realpath(recordings_path)
 
@@ -76,32 +133,44 @@ def make_mne_anatomy(subject, anatomy_path, recordings_path=None,
             subject=subject, data_type='freesurfer', output=output,
             mode=mode,
             processing='preprocessed', hcp_path=hcp_path)
-        for source in files:
-            match = [match for match in re.finditer(subject, source)][-1]
-            split_path = source[:match.span()[1] + 1]
-            target = op.join(this_anatomy_path, source.split(split_path)[-1])
-            if not op.isfile(target) and not op.islink(target):
-                os.symlink(source, target)
-
-    logger.info('reading extended structural processing ...')
+        _link_files(files, subject, this_anatomy_path)
 
-    # Step 1 #################################################################
-    # transform head models to expected coordinate system
+    tri_fname = op.join(this_anatomy_path, 'bem', 'inner_skull.surf')
+    trans_fname = op.join(this_recordings_path,
+                          '%s-head_mri-trans.fif' % subject)
+    state_fname = op.join(this_anatomy_path, _state_fname)
+    state = dict() if force else _read_state(state_fname)
 
-    # make hcp trans
     transforms_fname = get_file_paths(
         subject=subject, data_type='meg_anatomy', output='transforms',
         processing='preprocessed', hcp_path=hcp_path)
     transforms_fname = [k for k in transforms_fname if
                         k.endswith('transform.txt')][0]
-    hcp_trans = _read_trans_hcp(fname=transforms_fname, convert_to_meter=False)
-
-    # get RAS freesurfer trans
     c_ras_trans_fname = get_file_paths(
         subject=subject, data_type='freesurfer', output='mri',
         processing='preprocessed', hcp_path=hcp_path)
     c_ras_trans_fname = [k for k in c_ras_trans_fname if
                          k.endswith('c_ras.mat')][0]
+    head_model_fname = get_file_paths(
+        subject=subject, data_type='meg_anatomy', output='head_model',
+        processing='preprocessed', hcp_path=hcp_path)[0]
+    tri_inputs = [transforms_fname, c_ras_trans_fname, head_model_fname]
+    trans_inputs = [transforms_fname, c_ras_trans_fname]
+    do_tri = not _is_up_to_date(state, tri_fname, tri_inputs)
+    do_trans = not _is_up_to_date(state, trans_fname, trans_inputs)
+    if not (do_tri or do_trans):
+        logger.info('anatomy of %s is up to date' % subject)
+        return
+
+    logger.info('reading extended structural processing ...')
+
+    # Step 1 #################################################################
+    # transform head models to expected coordinate system
+
+    # make hcp trans
+    hcp_trans = _read_trans_hcp(fname=transforms_fname, convert_to_meter=False)
+
+    # get RAS freesurfer trans
     logger.info('reading RAS freesurfer transform')
     # ceci n'est pas un .mat file ...
 
@@ -113,30 +182,111 @@ def make_mne_anatomy(subject, anatomy_path, recordings_path=None,
     logger.info('Combining RAS transform and coregistration')
     ras_trans_m = linalg.inv(ras_trans)  # and the inversion
 
-    logger.info('extracting head model')
-    head_model_fname = get_file_paths(
-        subject=subject, data_type='meg_anatomy', output='head_model',
-        processing='preprocessed', hcp_path=hcp_path)[0]
-    pnts, faces = _get_head_model(head_model_fname=head_model_fname)
+    if do_tri:
+        logger.info('extracting head model')
+        pnts, faces = _get_head_model(head_model_fname=head_model_fname)
 
-    logger.info('coregistring head model to MNE-HCP coordinates')
-    pnts = apply_trans(ras_trans_m.dot(hcp_trans['bti2spm']), pnts)
+        logger.info('coregistring head model to MNE-HCP coordinates')
+        pnts = apply_trans(ras_trans_m.dot(hcp_trans['bti2spm']), pnts)
 
-    tri_fname = op.join(this_anatomy_path, 'bem', 'inner_skull.surf')
-    if not op.exists(op.dirname(tri_fname)):
-        os.makedirs(op.dirname(tri_fname))
-    write_surface(tri_fname, pnts, faces)
+        if not op.exists(op.dirname(tri_fname)):
+            os.makedirs(op.dirname(tri_fname))
+        write_surface(tri_fname, pnts, faces)
+        state[tri_fname] = _get_inputs_key(tri_inputs)
 
     # Step 2 #################################################################
     # write corresponding device to MRI transform
 
-    logger.info('extracting coregistration')
-    # now convert to everything meter too here
-    ras_trans_m[:3, 3] *= 1e-3
-    bti2spm = hcp_trans['bti2spm']
-    bti2spm[:3, 3] *= 1e-3
-    head_mri_t = Transform(  # we're lying here for a good purpose
-        'head', 'mri', np.dot(ras_trans_m, bti2spm))  # it should be 'ctf_head'
-    write_trans(
-        op.join(this_recordings_path, '%s-head_mri-trans.fif') % subject,
-        head_mri_t)
+    if do_trans:
+        logger.info('extracting coregistration')
+        # now convert to everything meter too here
+        ras_trans_m[:3, 3] *= 1e-3
+        bti2spm = hcp_trans['bti2spm']
+        bti2spm[:3, 3] *= 1e-3
+        head_mri_t = Transform(  # we're lying here for a good purpose
+            'head', 'mri', np.dot(ras_trans_m, bti2spm))  # should be ctf_head
+        write_trans(trans_fname, head_mri_t)
+        state[trans_fname] = _get_inputs_key(trans_inputs)
+
+    _write_state(state_fname, state)
+
+
+def make_mne_anatomy_batch(subjects, anatomy_path, recordings_path=None,
+                           hcp_path=op.curdir, mode='minimal',
+                           outputs=('label', 'mri', 'surf'), force=False,
+                           n_jobs=1, index_fname=None):
+    """Run `make_mne_anatomy` for many subjects in parallel
+
+    By default, only outputs whose HCP inputs changed since they were
+    last written are made again, hence re-running over many subjects
+    only redoes what is out of date.
+
+    Parameters
+    ----------
+    subjects : list of str
+        The subjects.
+    anatomy_path : str
+        The path corresponding to MNE/freesurfer SUBJECTS_DIR.
+    recordings_path : str | None
+        The path to which the coregistrations are written. If None,
+        `anatomy_path` is used.
+    hcp_path : str
+        The path where the HCP files can be found.
+    mode : {'minimal', 'full'}
+        See `make_mne_anatomy`.
+    outputs : {'label', 'mri', 'stats', 'surf', 'touch'}
+        See `make_mne_anatomy`.
+    force : bool
+        If True, all outputs are written again. Defaults to False.
+    n_jobs : int
+        The number of worker processes. Negative values count from the
+        number of CPUs. Defaults to 1.
+    index_fname : str | None
+        An index of `hcp_path` written by
+        `hcp.io.file_mapping.scan_hcp_path` with the same `mode`. If
+        given, subjects lacking inputs according to the index are skipped
+        and reported as failed, without looking at their files.
+
+    Returns
+    -------
+    failed : list of tuple
+        The (subject, error) of the subjects which failed, the others are
+        done nonetheless.
+    """
+    failed = list()
+    if index_fname is not None:
+        requirements = [dict(data_type='meg_anatomy', output=output)
+                        for output in ('transforms', 'head_model')]
+        requirements += [dict(data_type='freesurfer', output=output)
+                         for output in sorted(set(outputs) | set(['mri']))]
+        complete = set(find_subjects_hcp(index_fname, requirements))
+        for subject in subjects:
+            if str(subject) not in complete:
+                logger.warning('skipping %s, inputs are missing' % subject)
+                failed.append((subject, IOError(
+                    'The index lacks inputs of %s.' % subject)))
+        subjects = [subject for subject in subjects
+                    if str(subject) in complete]
+    kwargs = dict(anatomy_path=anatomy_path, recordings_path=recordings_path,
+                  hcp_path=hcp_path, mode=mode, outputs=outputs, force=force)
+    n_jobs = _get_n_jobs(n_jobs)
+    if n_jobs == 1:
+        for subject in subjects:
+            try:
+                make_mne_anatomy(subject, **kwargs)
+            except Exception as err:
+                logger.warning('anatomy of %s failed: %s' % (subject, err))
+                failed.append((subject, err))
+        return failed
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = [(subject, executor.submit(make_mne_anatomy, subject,
+                                             **kwargs))
+                   for subject in subjects]
+        for subject, future in futures:
+            try:
+                future.result()
+            except Exception as err:
+                logger.warning('anatomy of %s failed: %s' % (subject, err))
+                failed.append((subject, err))
+    return failed
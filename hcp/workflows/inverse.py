@@ -1,14 +1,136 @@
 # Author: Denis A. Engemann <denis.engemann@gmail.com>
 # License: BSD (3-clause)
 
+import os
 import os.path as op
+import hashlib
+import json
+import itertools as itt
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                FIRST_COMPLETED, as_completed, wait)
 
 import numpy as np
 
 import mne
+from mne.io.constants import FIFF
 from mne.io.pick import _pick_data_channels, pick_info
+from mne.minimum_norm import make_inverse_operator, prepare_inverse_operator
+from mne.minimum_norm.inverse import (
+    _assemble_kernel, _check_ch_names, _check_method, _check_ori,
+    _pick_channels_inverse_operator, _subject_from_inverse, combine_xyz)
+from mne.source_estimate import _make_stc
+from mne.utils import logger
 
-from ..io import read_info_hcp
+from ..io import read_info_hcp, read_annot_hcp
+from ..io.read import _get_raw_paths, _read_bti_header
+from ..io.cache import (_LRUCache, _get_file_key, _hash_key, get_cache_dir,
+                        _read_cache_entry, _write_cache_entry)
+from ..io.batch import _get_n_jobs
+
+# source spaces and BEM solutions keyed on their parameters and inputs
+_src_cache = _LRUCache(max_size=4)
+_morph_cache = _LRUCache(max_size=2)  # large with distances
+_bem_cache = _LRUCache(max_size=16)
+# file state (path, mtime, size) -> content hash
+_file_hashes = _LRUCache(max_size=1024)
+
+# src_params which do not change the source space
+_src_ignore = ('fname', 'n_jobs', 'subjects_dir', 'add_dist', 'overwrite',
+               'verbose')
+
+
+def _hash_file(fname):
+    """helper to hash the contents of a file, once per file state"""
+    key = _get_file_key(fname)
+    digest = _file_hashes.get(key)
+    if digest is None:
+        sha1 = hashlib.sha1()
+        with open(fname, 'rb') as fid:
+            for chunk in iter(lambda: fid.read(2 ** 20), b''):
+                sha1.update(chunk)
+        digest = sha1.hexdigest()
+        _file_hashes.set(key, digest)
+    return digest
+
+
+def _hash_surfaces(subjects_dir, subject, names):
+    """helper to hash the surfaces of both hemispheres that exist"""
+    fnames = [op.join(subjects_dir, subject, 'surf', '%s.%s' % (hemi, name))
+              for name in names for hemi in ('lh', 'rh')]
+    return [(op.basename(fname), _hash_file(fname)) for fname in fnames
+            if op.isfile(fname)]
+
+
+def _cached_artifact(key, make, read, write, suffix, memory, cache_dir):
+    """helper to reuse an MNE object made from the same parameters and inputs
+
+    Objects are kept in `memory` and, if a cache directory is set, in FIF
+    files named after the hash of `key`. If the file cannot be written,
+    e.g., because the disk is full, a warning is logged and the object
+    is returned nonetheless.
+    """
+    digest = _hash_key(key)
+    out = memory.get(digest)
+    if out is not None:
+        return out
+    cache_dir = get_cache_dir(cache_dir)
+    fname = None
+    if cache_dir is not None:
+        fname = op.join(cache_dir, 'forward', digest + suffix)
+        if op.isfile(fname):
+            logger.info('reading %s' % fname)
+            out = read(fname)
+    if out is None:
+        out = make()
+        if fname is not None:
+            tmp_fname = op.join(op.dirname(fname), '%s.%d.tmp%s' % (
+                                digest, os.getpid(), suffix))
+            try:
+                if not op.isdir(op.dirname(fname)):
+                    try:
+                        os.makedirs(op.dirname(fname))
+                    except OSError:  # created by another process meanwhile
+                        if not op.isdir(op.dirname(fname)):
+                            raise
+                write(tmp_fname, out)
+                os.replace(tmp_fname, fname)
+            except (IOError, OSError) as err:
+                logger.warning('could not write %s: %s' % (fname, err))
+                if op.exists(tmp_fname):
+                    os.remove(tmp_fname)
+    memory.set(digest, out)
+    return out
+
+
+def _get_src_params(src_params, anatomy_path, n_jobs):
+    """helper to complete src_params, distances are added after morphing"""
+    src_params = _update_dict_defaults(
+        src_params,
+        dict(subject='fsaverage', fname=None, spacing='oct6', n_jobs=n_jobs,
+             surface='white', subjects_dir=anatomy_path, add_dist=True))
+
+    add_source_space_distances = False
+    if src_params['add_dist']:  # we want the distances on the morphed space
+        src_params['add_dist'] = False
+        add_source_space_distances = True
+    return src_params, add_source_space_distances
+
+
+def _get_src_key(src_params):
+    """helper to identify a source space by parameters and surfaces"""
+    return ('src', sorted((k, v) for k, v in src_params.items()
+                          if k not in _src_ignore),
+            _hash_surfaces(src_params['subjects_dir'], src_params['subject'],
+                           [src_params['surface'], 'sphere']))
+
+
+def _get_src_fsaverage(src_params, cache_dir):
+    """helper to set up the template source space once per parameters"""
+    return _cached_artifact(
+        _get_src_key(src_params),
+        make=lambda: mne.setup_source_space(**src_params),
+        read=mne.read_source_spaces, write=mne.write_source_spaces,
+        suffix='-src.fif', memory=_src_cache, cache_dir=cache_dir)
 
 
 def make_mne_forward(anatomy_path,
@@ -16,7 +138,8 @@ def make_mne_forward(anatomy_path,
                      recordings_path,
                      info_from=(('data_type', 'rest'), ('run_index', 0)),
                      fwd_params=None, src_params=None,
-                     hcp_path=op.curdir, n_jobs=1):
+                     hcp_path=op.curdir, n_jobs=1, cache_dir=None,
+                     src_fsaverage=None):
     """"
     Convenience script for conducting standard MNE analyses.
 
@@ -48,6 +171,16 @@ def make_mne_forward(anatomy_path,
         The prefix of the path of the HCP data.
     n_jobs : int
         The number of jobs to use in parallel.
+    cache_dir : str | None
+        The directory in which the fsaverage source space, the morphed
+        source space and the BEM solution are stored for reuse. They are
+        keyed on the parameters and the content of the surfaces they are
+        made from. If None, the MNE config variable ``MNE_HCP_CACHE_DIR``
+        is used, if set. In any case they are reused within a session.
+        Reused objects are shared, hence do not modify them.
+    src_fsaverage : instance of SourceSpaces | None
+        The template source space set up with `src_params`, e.g., shared
+        across subjects. If None, it is set up or taken from the cache.
     """
     if isinstance(info_from, tuple):
         info_from = dict(info_from)
@@ -56,28 +189,42 @@ def make_mne_forward(anatomy_path,
         op.join(recordings_path, subject, '{}-head_mri-trans.fif'.format(
             subject)))
 
-    src_params = _update_dict_defaults(
-        src_params,
-        dict(subject='fsaverage', fname=None, spacing='oct6', n_jobs=n_jobs,
-             surface='white', subjects_dir=anatomy_path, add_dist=True))
+    src_params, add_source_space_distances = _get_src_params(
+        src_params, anatomy_path, n_jobs)
+    src_key = _get_src_key(src_params)
+    if src_fsaverage is None:
+        src_fsaverage = _get_src_fsaverage(src_params, cache_dir)
 
-    add_source_space_distances = False
-    if src_params['add_dist']:  # we want the distances on the morphed space
-        src_params['add_dist'] = False
-        add_source_space_distances = True
+    def make_src_subject():
+        src_subject = mne.morph_source_spaces(
+            src_fsaverage, subject, subjects_dir=anatomy_path)
+        if add_source_space_distances:  # and here we compute them post hoc.
+            src_subject = mne.add_source_space_distances(
+                src_subject, n_jobs=n_jobs)
+        return src_subject
 
-    src_fsaverage = mne.setup_source_space(**src_params)
-    src_subject = mne.morph_source_spaces(
-        src_fsaverage, subject, subjects_dir=anatomy_path)
+    morph_key = ('morph', src_key, subject, add_source_space_distances,
+                 _hash_surfaces(anatomy_path, subject,
+                                ['white', 'sphere.reg']),
+                 _hash_surfaces(src_params['subjects_dir'],
+                                src_params['subject'], ['sphere.reg']))
+    src_subject = _cached_artifact(
+        morph_key, make=make_src_subject, read=mne.read_source_spaces,
+        write=mne.write_source_spaces, suffix='-src.fif',
+        memory=_morph_cache, cache_dir=cache_dir)
 
-    if add_source_space_distances:  # and here we compute them post hoc.
-        src_subject = mne.add_source_space_distances(
-            src_subject, n_jobs=n_jobs)
+    def make_bem_sol():
+        bems = mne.make_bem_model(subject, conductivity=(0.3,),
+                                  subjects_dir=anatomy_path,
+                                  ico=None)  # ico = None for morphed SP.
+        return mne.make_bem_solution(bems)
 
-    bems = mne.make_bem_model(subject, conductivity=(0.3,),
-                              subjects_dir=anatomy_path,
-                              ico=None)  # ico = None for morphed SP.
-    bem_sol = mne.make_bem_solution(bems)
+    bem_key = ('bem', subject, (0.3,), None, _hash_file(
+        op.join(anatomy_path, subject, 'bem', 'inner_skull.surf')))
+    bem_sol = _cached_artifact(
+        bem_key, make=make_bem_sol, read=mne.read_bem_solution,
+        write=mne.write_bem_solution, suffix='-bem-sol.fif',
+        memory=_bem_cache, cache_dir=cache_dir)
 
     info = read_info_hcp(subject=subject, hcp_path=hcp_path, **info_from)
     picks = _pick_data_channels(info, with_ref_meg=False)
@@ -98,6 +245,424 @@ def make_mne_forward(anatomy_path,
                 bem_sol=bem_sol, info=info)
 
 
+# template directory -> source space, loaded once per worker process
+_shared_templates = dict()
+
+
+def _write_template(src, template_dir):
+    """helper to store a source space as memory-mappable arrays"""
+    if not op.isfile(op.join(template_dir, 'header.json')):
+        _write_cache_entry(template_dir, dict(hemis=list(src), info=src.info),
+                           sources=[])
+
+
+def _read_template(template_dir):
+    """helper to load a source space whose arrays are memory mapped
+
+    The pages are shared by all processes until they are written to.
+    """
+    src = _shared_templates.get(template_dir)
+    if src is None:
+        contents = _read_cache_entry(template_dir, sources=[])
+        src = mne.SourceSpaces(contents['hemis'], contents['info'])
+        _shared_templates[template_dir] = src
+    return src
+
+
+def _make_forward_file(subject, template_dir, fname, kwargs):
+    """helper to compute and write the forward solution of one subject"""
+    src_fsaverage = _read_template(template_dir)
+    fwd = make_mne_forward(subject=subject, src_fsaverage=src_fsaverage,
+                           **kwargs)['fwd']
+    tmp_fname = '%s.%d.tmp-fwd.fif' % (fname[:-len('-fwd.fif')], os.getpid())
+    mne.write_forward_solution(tmp_fname, fwd, overwrite=True)
+    os.replace(tmp_fname, fname)
+    return fname
+
+
+def make_mne_forward_cohort(subjects, anatomy_path, recordings_path,
+                            fwd_path,
+                            info_from=(('data_type', 'rest'),
+                                       ('run_index', 0)),
+                            src_params=None, hcp_path=op.curdir, n_jobs=1,
+                            cache_dir=None, overwrite=False):
+    """Compute and write the forward solutions of many subjects in parallel
+
+    The fsaverage source space is set up once and stored as memory-mapped
+    arrays, which all worker processes share instead of holding copies.
+    Each forward solution is written as soon as it is done to
+    ``$fwd_path/$subject-fwd.fif`` and the outcome of every subject is
+    recorded in ``$fwd_path/forward-status.json``. Subjects whose forward
+    solution exists are skipped, hence re-running completes an interrupted
+    or partially failed cohort.
+
+    Parameters
+    ----------
+    subjects : list of str
+        The subjects.
+    anatomy_path : str
+        The directory containing the extracted HCP subject data.
+    recordings_path : str
+        The path where MEG data and transformations are stored.
+    fwd_path : str
+        The directory to write the forward solutions to.
+    info_from : tuple of tuples | dict
+        See `make_mne_forward`.
+    src_params : None | dict
+        See `make_mne_forward`.
+    hcp_path : str
+        The prefix of the path of the HCP data.
+    n_jobs : int
+        The number of worker processes, each computes one subject at a
+        time. Negative values count from the number of CPUs. Defaults
+        to 1.
+    cache_dir : str | None
+        See `make_mne_forward`.
+    overwrite : bool
+        If True, forward solutions are computed again even if they
+        exist. Defaults to False.
+
+    Returns
+    -------
+    failed : list of tuple
+        The (subject, error) of the subjects which failed, the others are
+        done nonetheless.
+    """
+    n_jobs = _get_n_jobs(n_jobs)
+    if not op.isdir(fwd_path):
+        os.makedirs(fwd_path)
+    template_params, _ = _get_src_params(src_params, anatomy_path, n_jobs)
+    src_fsaverage = _get_src_fsaverage(template_params, cache_dir)
+    template_dir = op.join(fwd_path, '.template-%s' % _hash_key(
+        _get_src_key(template_params)))
+    _write_template(src_fsaverage, template_dir)
+
+    kwargs = dict(anatomy_path=anatomy_path, recordings_path=recordings_path,
+                  info_from=info_from, src_params=src_params,
+                  hcp_path=hcp_path, n_jobs=1, cache_dir=cache_dir)
+    status_fname = op.join(fwd_path, 'forward-status.json')
+    status = dict()
+    if op.isfile(status_fname):
+        with open(status_fname, 'r') as fid:
+            status = json.load(fid)
+
+    def checkpoint(subject, error):
+        status[subject] = 'done' if error is None else repr(error)
+        tmp_fname = '%s.%d.tmp' % (status_fname, os.getpid())
+        with open(tmp_fname, 'w') as fid:
+            json.dump(status, fid, indent=1, sort_keys=True)
+        os.replace(tmp_fname, status_fname)
+        if error is not None:
+            logger.warning('forward of %s failed: %s' % (subject, error))
+
+    todo = list()
+    for subject in subjects:
+        fname = op.join(fwd_path, '%s-fwd.fif' % subject)
+        if op.isfile(fname) and not overwrite:
+            logger.info('forward of %s exists' % subject)
+        else:
+            todo.append((subject, fname))
+    failed = list()
+    if n_jobs == 1:
+        for subject, fname in todo:
+            try:
+                _make_forward_file(subject, template_dir, fname, kwargs)
+            except Exception as err:
+                failed.append((subject, err))
+                checkpoint(subject, err)
+            else:
+                checkpoint(subject, None)
+        return failed
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = dict(
+            (executor.submit(_make_forward_file, subject, template_dir,
+                             fname, kwargs), subject)
+            for subject, fname in todo)
+        for future in as_completed(futures):
+            subject = futures[future]
+            try:
+                future.result()
+            except Exception as err:
+                failed.append((subject, err))
+                checkpoint(subject, err)
+            else:
+                checkpoint(subject, None)
+    return failed
+
+
+def _merge_moments(moments_a, moments_b):
+    """helper to merge sample counts, means and scatter matrices
+
+    This is the pairwise update of Chan et al., which is stable as it only
+    sums centered products.
+    """
+    n_a, mean_a, scatter_a = moments_a
+    n_b, mean_b, scatter_b = moments_b
+    if n_a == 0:
+        return moments_b
+    if n_b == 0:
+        return moments_a
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (n_b / float(n))
+    scatter = scatter_a + scatter_b
+    scatter += np.outer(delta, delta) * (n_a * n_b / float(n))
+    return n, mean, scatter
+
+
+def _chunk_moments(data, start, bad_segments=None):
+    """helper to reduce a chunk to its sample count, mean and scatter matrix
+
+    `start` is the index of the first sample of the chunk, `bad_segments`
+    holds the first and last samples (included) of segments to leave out.
+    The data may be modified in place.
+    """
+    if bad_segments is not None:
+        keep = np.ones(data.shape[1], dtype=bool)
+        for first, last in bad_segments:
+            keep[max(first - start, 0):max(last + 1 - start, 0)] = False
+        data = data[:, keep]
+    if data.shape[1] == 0:
+        return 0, None, None
+    mean = data.mean(axis=1)
+    data -= mean[:, np.newaxis]
+    return data.shape[1], mean, np.dot(data, data.T)
+
+
+def _reduce_chunks(compute_moments, starts, n_jobs):
+    """helper to merge the moments of chunks computed by threads
+
+    At most `n_jobs` chunks are in flight and their moments are merged as
+    they come in, such that memory does not grow with the number of
+    chunks.
+    """
+    moments = (0, None, None)
+    if n_jobs == 1:
+        for start in starts:
+            moments = _merge_moments(moments, compute_moments(start))
+        return moments
+    starts = iter(starts)
+    # reading and BLAS release the GIL
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        pending = set(executor.submit(compute_moments, start)
+                      for start in itt.islice(starts, n_jobs))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:  # merging is order independent
+                moments = _merge_moments(moments, future.result())
+            pending |= set(executor.submit(compute_moments, start)
+                           for start in itt.islice(starts, len(done)))
+    return moments
+
+
+def compute_noise_cov_hcp(subject, data_type='noise_empty_room', run_index=0,
+                          hcp_path=op.curdir, picks=None, ica=None,
+                          bad_segments=None, chunk_duration=10., n_jobs=1):
+    """Compute the noise covariance of a run in one pass over the 4D file
+
+    The data are read in chunks, each thread reduces its chunks to a mean
+    and a scatter matrix, which are merged as they come in. At most
+    `n_jobs` chunks are in flight, hence memory scales with the number of
+    channels squared, not with the duration of the run.
+
+    Parameters
+    ----------
+    subject : str
+        The subject.
+    data_type : str
+        The kind of data, usually 'noise_empty_room' or 'noise_subject',
+        but any raw data type is supported.
+    run_index : int
+        The run index. Defaults to 0.
+    hcp_path : str
+        The HCP directory, defaults to op.curdir.
+    picks : array-like of int | None
+        The channels. If None, the MEG channels without the reference
+        channels are used.
+    ica : instance of ICAProjector | None
+        If given, its components are projected out. As the projection is
+        linear, it is applied to the covariance rather than to the data.
+        See `hcp.preprocessing.make_ica_projector_hcp`.
+    bad_segments : str | array, shape (n_segments, 2) | None
+        The segments to exclude as 0-based first and last samples. If str,
+        the key of the bad segments of this run, e.g., 'all', see
+        `hcp.io.read_annot_hcp`.
+    chunk_duration : float
+        The duration of the chunks read at once in seconds. Defaults
+        to 10.
+    n_jobs : int
+        The number of threads reading and reducing chunks. Defaults to 1.
+
+    Returns
+    -------
+    cov : instance of Covariance
+        The noise covariance.
+    """
+    pdf, config, read_data = _get_raw_paths(
+        subject, data_type, run_index, hcp_path)
+    info, bti_info = _read_bti_header(pdf, config)
+    if picks is None:
+        picks = mne.pick_types(info, meg=True, ref_meg=False)
+    picks = np.atleast_1d(picks)
+    ch_names = [info['ch_names'][pick] for pick in picks]
+    if isinstance(bad_segments, str):
+        bad_segments = read_annot_hcp(
+            subject=subject, data_type=data_type, run_index=run_index,
+            hcp_path=hcp_path)['segments'][bad_segments]
+    n_times = bti_info['total_slices']
+    n_chunk = max(int(round(chunk_duration * info['sfreq'])), 1)
+
+    def compute_moments(start):
+        stop = min(start + n_chunk, n_times)
+        data = read_data(info, bti_info, start, stop, picks)
+        return _chunk_moments(data, start, bad_segments)
+
+    n_samples, _, scatter = _reduce_chunks(
+        compute_moments, range(0, n_times, n_chunk), _get_n_jobs(n_jobs))
+    if n_samples < 2:
+        raise ValueError('Not enough good samples to compute a covariance.')
+    cov = scatter / (n_samples - 1)
+
+    if ica is not None:
+        missing = [ch for ch in ica.ch_names if ch not in ch_names]
+        if missing:
+            raise ValueError('The picks lack channels of the ICA solution: '
+                             '%s' % ', '.join(missing))
+        idx = np.array([ch_names.index(ch) for ch in ica.ch_names])
+        proj = np.eye(len(ch_names))
+        proj[np.ix_(idx, idx)] -= np.dot(ica.mixing, ica.unmixing)
+        cov = np.dot(np.dot(proj, cov), proj.T)
+
+    logger.info('noise covariance from %d samples' % n_samples)
+    return mne.Covariance(cov, ch_names, bads=[], projs=[],
+                          nfree=n_samples - 1, method='empirical')
+
+
+def make_mne_inverse(forward, noise_cov, loose=0.2, depth=0.8,
+                     fixed=False):
+    """Make the inverse operator for a forward model of `make_mne_forward`
+
+    Parameters
+    ----------
+    forward : dict
+        The output of `make_mne_forward`, its 'fwd' and 'info' are used.
+    noise_cov : instance of Covariance
+        The noise covariance, e.g., from `compute_noise_cov_hcp`.
+    loose : float | None
+        The loose orientation parameter. Defaults to 0.2.
+    depth : float | None
+        The depth weighting. Defaults to 0.8.
+    fixed : bool
+        Whether to use fixed source orientations. Defaults to False.
+
+    Returns
+    -------
+    inverse_operator : instance of InverseOperator
+        The inverse operator.
+    """
+    return make_inverse_operator(
+        forward['info'], forward['fwd'], noise_cov, loose=loose, depth=depth,
+        fixed=fixed)
+
+
+def _apply_kernel(kernel, noise_norm, is_free_ori, data, sel, dtype):
+    """helper to source estimate a batch of epochs by one matrix product
+
+    `data` is (n_epochs, n_channels, n_times), of which the channels `sel`
+    are used. The solutions are returned as views into one
+    (n_sources, n_epochs * n_times) array, such that no copy per epoch is
+    needed.
+    """
+    n_epochs, _, n_times = data.shape
+    # (n_channels, n_epochs * n_times), epoch after epoch
+    stacked = np.empty((len(sel), n_epochs * n_times), dtype)
+    for ii, epoch in enumerate(data):
+        stacked[:, ii * n_times:(ii + 1) * n_times] = epoch[sel]
+    sol = np.dot(kernel, stacked)
+    del stacked
+    if is_free_ori:  # combining the current components is not linear
+        sol = combine_xyz(sol)
+        if noise_norm is not None:
+            sol *= noise_norm
+    return [sol[:, ii * n_times:(ii + 1) * n_times]
+            for ii in range(n_epochs)]
+
+
+def apply_inverse_epochs_hcp(epochs, inverse_operator, lambda2=1. / 9.,
+                             method='dSPM', pick_ori=None, max_bytes=2 ** 30,
+                             dtype=np.float64):
+    """Apply an inverse operator to many epochs at once
+
+    Unlike `mne.minimum_norm.apply_inverse_epochs`, which multiplies the
+    kernel with one epoch at a time, the epochs are stacked along time and
+    each batch is source estimated by a single matrix product. The epochs
+    are read batch by batch, hence epochs which are not preloaded are
+    never loaded at once.
+
+    Parameters
+    ----------
+    epochs : instance of Epochs
+        The epochs, e.g., from `hcp.io.read_epochs_hcp`.
+    inverse_operator : instance of InverseOperator
+        The inverse operator, e.g., from `make_mne_inverse`.
+    lambda2 : float
+        The regularization parameter. Defaults to 1 / 9.
+    method : 'MNE' | 'dSPM' | 'sLORETA'
+        The inverse method. Defaults to 'dSPM'.
+    pick_ori : None | 'normal'
+        See `mne.minimum_norm.apply_inverse_epochs`.
+    max_bytes : int
+        The memory budget of a batch, covering the data read, the stacked
+        channels and the solutions. The number of epochs per batch is
+        derived from it. At least one epoch is processed at a time.
+        Defaults to 1 GB.
+    dtype : numpy dtype
+        The precision of the kernel, the data and the solutions. Use
+        np.float32 to halve memory and roughly double the speed.
+        Defaults to np.float64.
+
+    Returns
+    -------
+    stcs : list of SourceEstimate
+        The source estimates, one per epoch.
+    """
+    method = _check_method(method)
+    pick_ori = _check_ori(pick_ori)
+    _check_ch_names(inverse_operator, epochs.info)
+    inv = prepare_inverse_operator(inverse_operator, 1, lambda2, method)
+    sel = _pick_channels_inverse_operator(epochs.ch_names, inv)
+    kernel, noise_norm, vertno = _assemble_kernel(inv, None, method, pick_ori)
+    is_free_ori = (inverse_operator['source_ori'] ==
+                   FIFF.FIFFV_MNE_FREE_ORI and pick_ori is None)
+    if not is_free_ori and noise_norm is not None:
+        kernel *= noise_norm  # premultiply, the inverse is linear
+    kernel = kernel.astype(dtype)
+    if noise_norm is not None:
+        noise_norm = noise_norm.astype(dtype)
+
+    n_epochs, n_times = len(epochs), len(epochs.times)
+    # the float64 data read, the stacked channels and the solutions
+    epoch_bytes = n_times * (len(epochs.ch_names) * 8 +
+                             (len(sel) + len(kernel)) *
+                             np.dtype(dtype).itemsize)
+    batch_size = max(int(max_bytes // epoch_bytes), 1)
+    logger.info('source estimating %d epochs per batch' % batch_size)
+    tmin, tstep = epochs.times[0], 1. / epochs.info['sfreq']
+    subject = _subject_from_inverse(inverse_operator)
+    stcs = list()
+    for start in range(0, n_epochs, batch_size):
+        stop = min(start + batch_size, n_epochs)
+        data = epochs[start:stop].get_data()
+        for this_sol in _apply_kernel(kernel, noise_norm, is_free_ori, data,
+                                      sel, dtype):
+            stcs.append(_make_stc(this_sol, vertices=vertno, tmin=tmin,
+                                  tstep=tstep, subject=subject))
+        del data
+        logger.info('source estimated %d of %d epochs' % (stop, n_epochs))
+    return stcs
+
+
 def _update_dict_defaults(values, defaults):
     """Helper to handle dict updates"""
     out = {k: v for k, v in defaults.items()}
@@ -0,0 +1,106 @@
+import threading
+import time
+import weakref
+
+import os
+import os.path as op
+
+import numpy as np
+from nose.tools import assert_equal, assert_true
+from mne.utils import _TempDir
+
+from hcp.io.cache import _LRUCache
+
+from hcp.workflows.inverse import (_apply_kernel, _cached_artifact,
+                                   _chunk_moments, _merge_moments,
+                                   _reduce_chunks)
+
+
+def test_merge_moments():
+    """Test chunked covariances with bad segments match np.cov"""
+    rng = np.random.RandomState(42)
+    data = rng.randn(5, 1000) + rng.randn(5, 1)  # non zero means
+    bad_segments = np.array([[100, 149], [395, 420], [990, 1200]])
+    keep = np.ones(data.shape[1], dtype=bool)
+    for first, last in bad_segments:
+        keep[first:last + 1] = False
+    bounds = [0, 7, 120, 140, 400, 401, 733, 1000]  # uneven chunks
+    moments = (0, None, None)
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        moments = _merge_moments(moments, _chunk_moments(
+            data[:, start:stop].copy(), start, bad_segments))
+    n_samples, mean, scatter = moments
+    assert_equal(n_samples, keep.sum())
+    np.testing.assert_allclose(mean, data[:, keep].mean(axis=1))
+    np.testing.assert_allclose(scatter / (n_samples - 1),
+                               np.cov(data[:, keep]))
+    # a chunk with bad samples only does not count
+    assert_equal(
+        _chunk_moments(data[:, 120:140].copy(), 120, bad_segments)[0], 0)
+
+
+def test_reduce_chunks():
+    """Test threaded chunk reductions hold few results and match np.cov"""
+    rng = np.random.RandomState(0)
+    data = rng.randn(4, 500)
+    lock = threading.Lock()
+    counts = dict(alive=0, max_alive=0)
+
+    def release():
+        with lock:
+            counts['alive'] -= 1
+
+    def compute_moments(start):
+        if start == 0:  # a slow chunk, the others must not pile up
+            time.sleep(0.2)
+        moments = _chunk_moments(data[:, start:start + 10].copy(), start)
+        with lock:
+            counts['alive'] += 1
+            counts['max_alive'] = max(counts['max_alive'], counts['alive'])
+        weakref.finalize(moments[2], release)
+        return moments
+
+    for n_jobs in (1, 3):
+        n_samples, _, scatter = _reduce_chunks(
+            compute_moments, range(0, 500, 10), n_jobs)
+        assert_equal(n_samples, 500)
+        np.testing.assert_allclose(scatter / (n_samples - 1), np.cov(data))
+        assert_true(counts['max_alive'] <= 2 * n_jobs + 1)
+
+
+def test_apply_kernel():
+    """Test batched source estimates match the epoch by epoch product"""
+    rng = np.random.RandomState(0)
+    kernel = rng.randn(20, 6)
+    data = rng.randn(4, 8, 11)
+    sel = np.array([0, 2, 3, 4, 6, 7])
+    sols = _apply_kernel(kernel, None, False, data, sel, np.float64)
+    assert_equal(len(sols), len(data))
+    for sol, epoch in zip(sols, data):
+        np.testing.assert_allclose(sol, np.dot(kernel, epoch[sel]))
+    sols = _apply_kernel(kernel.astype(np.float32), None, False, data, sel,
+                         np.float32)
+    assert_equal(sols[0].dtype, np.float32)
+    np.testing.assert_allclose(sols[-1], np.dot(kernel, data[-1][sel]),
+                               rtol=1e-4, atol=1e-4)
+
+
+def test_cached_artifact_write_error():
+    """Test artifacts are returned when they cannot be written"""
+    tmp = _TempDir()
+
+    def write(fname, obj):
+        with open(fname, 'w') as fid:
+            fid.write('partial')
+        raise IOError('No space left on device')
+
+    out = _cached_artifact(('a',), lambda: 'made', None, write, '.fif',
+                           _LRUCache(max_size=1), cache_dir=tmp)
+    assert_equal(out, 'made')
+    assert_equal(os.listdir(op.join(tmp, 'forward')), [])
+    # the directory cannot be made
+    os.rmdir(op.join(tmp, 'forward'))
+    open(op.join(tmp, 'forward'), 'w').close()
+    out = _cached_artifact(('b',), lambda: 'made', None, write, '.fif',
+                           _LRUCache(max_size=1), cache_dir=tmp)
+    assert_equal(out, 'made')
@@ -62,6 +62,8 @@ if __name__ == "__main__":
           packages=['hcp',
                     'hcp.io',
                     'hcp.io.file_mapping',
-                    'hcp.workflows'],
+                    'hcp.workflows',
+                    'hcp.commands'],
+          scripts=['bin/hcp'],
           package_data={'hcp': [
               op.join('io', 'file_mapping', 'data', '*txt')]})